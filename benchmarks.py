@@ -0,0 +1,837 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the pitch detector, that do not need any audio device.
+
+Run `python benchmarks.py` to run all of them.
+
+Run `python benchmarks.py --suite -o results.jsonl` to measure the throughput
+of the pitch detection, filters and synths, as JSON lines. With
+`--baseline results.jsonl`, the results are compared to a previous run, and
+the exit status is 1 if any of them is slower by more than the tolerance.
+"""
+import argparse
+import collections
+import contextlib
+import functools
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+import filters
+import synth
+import crowd_synth
+from multipitch import MultiPitchFinder
+from periodfinder import PeriodFinder, PeriodFinderBank, _root
+from yinfinder import YinFinder
+
+
+def chirp_signal(duration=10, f0=50, f1=1000, noise_lv=0.1, fs=44100, seed=0):
+    """The noisy chirp of `periodfinder.py`, and its instantaneous frequency.
+
+    The noise is the same for the same seed, so that results can be
+    compared between runs.
+    """
+    import scipy.signal as ssi
+    t = np.arange(0, duration, 1/fs)
+    ft = f0 * (f1/f0)**(t/max(t))
+    chirp = ssi.chirp(t, f0, max(t), f1, method='log')
+    chirp += np.random.default_rng(seed).standard_normal(len(chirp)) * noise_lv
+    return chirp, ft
+
+
+def timeit(func, repeat=3):
+    """Best wall-clock time of `repeat` calls to func(), in seconds."""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+class _LoopPeriodFinder(PeriodFinder):
+    """`PeriodFinder` as it was, handling rising zeros one at a time."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._last_periods = collections.deque([], self._n_periods)
+
+    def analyze(self, indata):
+        filtered = self._filtered(indata)
+        sign_changes = np.diff((filtered > 0)*1, prepend=self._last_value > 0)
+        rising, = np.where(sign_changes == 1)
+        for i in rising:
+            if i == 0:
+                assert self._last_value <= 0 and filtered[0] > 0
+                self._record_rising_zero(_root(-1, 0, self._last_value, filtered[0]))
+            else:
+                assert filtered[i-1] <= 0 and filtered[i] > 0
+                self._record_rising_zero(_root(i-1, i, filtered[i-1], filtered[i]))
+        self._last_value = filtered[-1]
+        self._samples_seen += len(indata)
+
+    def _record_rising_zero(self, samples_local):
+        samples_abs = samples_local + self._samples_seen
+        self._last_periods.append(samples_abs - self._last_period_beginning)
+        self._last_period_beginning = samples_abs
+
+    def get_estimated_period(self):
+        if len(self._last_periods) == 0:
+            return np.nan
+        return sum(self._last_periods) / len(self._last_periods)
+
+
+def _run_blocks(estimator, signal, blocksize):
+    return [estimator(signal[k:k+blocksize])
+            for k in range(0, len(signal) - blocksize + 1, blocksize)]
+
+
+def bench_periodfinder_loop(f=1000, duration=10, fs=44100):
+    """Compare `PeriodFinder.analyze` to the per-crossing Python loop.
+
+    The crossing analysis is timed alone (without any filter),
+    then with the default filter.
+    """
+    signal = np.sin(2*np.pi * f * np.arange(duration*fs) / fs + 0.1)
+    for filtered in (False, True):
+        for blocksize in (256, 1024, 4096):
+            def run(cls):
+                filt = None if filtered else (lambda x, out=None: x)
+                return _run_blocks(cls(fs=fs, filt=filt), signal, blocksize)
+            # Check that both give the same estimates
+            assert np.allclose(run(PeriodFinder), run(_LoopPeriodFinder))
+            t_loop = timeit(lambda: run(_LoopPeriodFinder))
+            t_vect = timeit(lambda: run(PeriodFinder))
+            print("PeriodFinder at {} Hz, {}, blocks of {}: loop {:.3f}s, "
+                  "vectorized {:.3f}s, speedup x{:.1f}"
+                  .format(f, "filtered" if filtered else "analysis only",
+                          blocksize, t_loop, t_vect, t_loop/t_vect))
+
+
+def bench_periodfinder_bank(blocksize=256, duration=2, fs=44100):
+    """Compare one `PeriodFinderBank` to one `PeriodFinder` per channel."""
+    for channels in (1, 8, 64):
+        signal = np.random.randn(duration*fs, channels)
+        def run_separate():
+            finders = [PeriodFinder(fs=fs) for _ in range(channels)]
+            for k in range(0, len(signal) - blocksize + 1, blocksize):
+                block = signal[k:k+blocksize]
+                [pf(block[:, c]) for c, pf in enumerate(finders)]
+        def run_bank():
+            _run_blocks(PeriodFinderBank(channels, fs=fs), signal, blocksize)
+        t_separate = timeit(run_separate, repeat=2)
+        t_bank = timeit(run_bank, repeat=2)
+        print("{} channels, blocks of {}: separate {:.3f}s, "
+              "bank {:.3f}s, speedup x{:.1f}"
+              .format(channels, blocksize, t_separate, t_bank,
+                      t_separate/t_bank))
+
+
+def bench_estimators(blocksize=256, fs=44100):
+    """Accuracy and speed of the pitch estimators on the chirp test."""
+    chirp, ft = chirp_signal(fs=fs)
+    f_correct = ft[blocksize-1::blocksize]
+    for name, cls in [('PeriodFinder', PeriodFinder), ('YinFinder', YinFinder)]:
+        f_estimates = np.array(_run_blocks(cls(fs=fs), chirp, blocksize))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cents = np.abs(1200 * np.log2(f_estimates / f_correct))
+        cents[~np.isfinite(cents)] = np.inf
+        # Do not count the time needed to fill the estimators
+        cents = cents[int(0.1*fs/blocksize):]
+        elapsed = timeit(lambda: _run_blocks(cls(fs=fs), chirp, blocksize),
+                         repeat=1)
+        print("{}: median error {:.1f} cents, {:.0f}% within 50 cents, "
+              "{:.0f}x real time".format(name, np.median(cents),
+                                         100*np.mean(cents < 50),
+                                         len(chirp)/fs/elapsed))
+
+
+def bench_decimation(fs=44100):
+    """Speed and accuracy of PeriodFinder with a decimated front end.
+
+    Decimation only pays off with large blocks: with blocks of 256, the
+    cost of each call dominates, and decimating is slower.
+    """
+    chirp, ft = chirp_signal(fs=fs)
+    for blocksize in (256, 1024, 8192):
+        f_correct = ft[blocksize-1::blocksize]
+        for decimation in (1, 4, 8):
+            create = lambda: PeriodFinder(fs=fs, decimation=decimation)
+            f_estimates = np.array(_run_blocks(create(), chirp, blocksize))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                cents = np.abs(1200 * np.log2(f_estimates / f_correct))
+            cents = np.nan_to_num(cents, nan=np.inf)[int(0.1*fs/blocksize):]
+            elapsed = timeit(lambda: _run_blocks(create(), chirp, blocksize))
+            print("PeriodFinder, blocks of {}, decimation by {}: {:.0f}x real "
+                  "time, median error {:.1f} cents".format(
+                          blocksize, decimation, len(chirp)/fs/elapsed,
+                          np.median(cents)))
+
+
+def _chord_progression(chords, duration=1.0):
+    """Chords of SimplePolySynth, each held for duration seconds, and the
+    notes playing at the end of each block of 256 samples."""
+    synth_ = synth.SimplePolySynth(synth.OFFSET_TRI_01, synth.ORGAN_ENVELOPE)
+    blocks, notes = [], []
+    for chord in chords:
+        for note in chord:
+            synth_.note_on(note, 100)
+        for _ in range(int(duration * synth.SAMPLERATE / 256)):
+            blocks.append(synth_.get_data(256))
+            notes.append(set(chord))
+        for note in chord:
+            synth_.note_off(note)
+    return np.concatenate(blocks), notes
+
+
+def bench_multipitch():
+    """Speed and accuracy of MultiPitchFinder on the chords of a synth."""
+    fs = synth.SAMPLERATE
+    chords = [(48, 52, 55), (57, 60, 64, 69), (50, 57, 65), (43, 59, 62),
+              (48, 55, 64, 72), (45, 52, 60, 64)] * 2
+    signal, notes = _chord_progression(chords)
+
+    def live():
+        finder = MultiPitchFinder(fs=fs)
+        return [finder(block).copy() for block in signal.reshape(-1, 256)]
+
+    def offline():
+        return MultiPitchFinder(fs=fs).analyze(signal)[0]
+
+    # Frames ending with the blocks where a frame ends, the hop being 512
+    estimates = np.array(live())[1::2]
+    found = [set(np.rint(69 + 12*np.log2(f[np.isfinite(f)]/440)).astype(int))
+             for f in estimates]
+    correct = np.array([a == b for a, b in zip(found, notes[1::2])])
+    # Frames more than 0.3s after a chord change, past the release of the
+    # previous chord and the attack
+    steady = np.arange(len(correct)) % (len(correct) // len(chords)) \
+             >= 0.3 * fs / 512
+    print("MultiPitchFinder, chords of 3 and 4 notes: right notes in {:.0%} "
+          "of all frames, {:.0%} of frames 0.3s after a change".format(
+                  correct.mean(), correct[steady].mean()))
+    for name, run in [('live blocks of 256', live),
+                      ('offline, one call', offline)]:
+        elapsed = timeit(run)
+        print("MultiPitchFinder, {}: {:.0f}x real time".format(
+                name, len(signal)/fs/elapsed))
+
+
+def bench_silence_gate(blocksize=256, duration=2, fs=44100):
+    """Cost of silent blocks, with and without the gate of PeriodFinder."""
+    silence = 1e-4 * np.random.randn(duration*fs)
+    t_analyzed = timeit(lambda: _run_blocks(PeriodFinder(fs=fs, gate_level=0),
+                                            silence, blocksize))
+    t_gated = timeit(lambda: _run_blocks(PeriodFinder(fs=fs), silence,
+                                         blocksize))
+    print("PeriodFinder, silent blocks of {}: analyzed {:.1f}us, "
+          "gated {:.1f}us per block".format(
+                  blocksize, t_analyzed/(len(silence)//blocksize)*1e6,
+                  t_gated/(len(silence)//blocksize)*1e6))
+
+    channels, active = 64, 4
+    signal = np.random.randn(duration*fs, channels)
+    signal[:, active:] *= 1e-4
+    for gate_level in (0, 1e-3):
+        elapsed = timeit(lambda: _run_blocks(
+                PeriodFinderBank(channels, fs=fs, gate_level=gate_level),
+                signal, blocksize), repeat=2)
+        print("PeriodFinderBank, {} of {} channels silent, {}: {:.0f}x real "
+              "time".format(channels - active, channels,
+                            "gated" if gate_level else "all analyzed",
+                            duration/elapsed))
+
+
+def bench_filter_design(n=1000):
+    """Time to create a `PeriodFinder`, with and without designing its filter."""
+    def create(clear_cache):
+        for _ in range(n):
+            if clear_cache:
+                filters._sos_cache.clear()
+            PeriodFinder()
+    t_design = timeit(lambda: create(True))
+    t_cached = timeit(lambda: create(False))
+    print("Creating a PeriodFinder: {:.1f}us with filter design, "
+          "{:.1f}us with cached design"
+          .format(t_design/n*1e6, t_cached/n*1e6))
+
+
+def bench_filter_inplace(duration=2, fs=44100):
+    """Throughput of `Filter`, allocating the output or writing it in place."""
+    signal = np.random.randn(duration*fs)
+    for blocksize in (32, 64, 256, 1024):
+        filt = filters.bandpass_and_integrate(fs=fs)
+        out = np.empty(blocksize)
+        blocks = range(0, len(signal) - blocksize + 1, blocksize)
+        t_alloc = timeit(lambda: [filt(signal[k:k+blocksize]) for k in blocks])
+        t_inplace = timeit(lambda: [filt(signal[k:k+blocksize], out=out)
+                                    for k in blocks])
+        print("Filter, blocks of {}: {:.2f}us per block allocating, "
+              "{:.2f}us in place"
+              .format(blocksize, t_alloc/len(blocks)*1e6,
+                      t_inplace/len(blocks)*1e6))
+
+
+class _ObjectPolySynth(synth.PolyphonicSynth):
+    """`SimplePolySynth` as it was, with one `OneNoteSynth` per note."""
+    def __init__(self, waveform, envelope, **kwargs):
+        super().__init__(**kwargs)
+        self._waveform, self._envelope = waveform, envelope
+
+    def create_note(self, note_number, velocity):
+        return synth.OneNoteSynth(synth.freq_of_note(note_number),
+                                  velocity/128, self._waveform, self._envelope)
+
+
+def _time_synth(synth_, n_notes, blocksize=256, n_blocks=100):
+    """Time per block of a synth holding n_notes notes."""
+    for note in range(n_notes):
+        synth_.note_on(note, 100)
+    synth_.get_data(blocksize)
+    return timeit(lambda: [synth_.get_data(blocksize)
+                           for _ in range(n_blocks)]) / n_blocks
+
+
+def bench_polyphony(blocksize=256):
+    """Time to render a block with many notes, compared to the deadline."""
+    deadline = blocksize / synth.SAMPLERATE
+    for n_notes in (10, 100, 300):
+        kwargs = dict(waveform=synth.OFFSET_TRI_01,
+                      envelope=synth.ORGAN_ENVELOPE, max_polyphony=n_notes)
+        t_objects = _time_synth(_ObjectPolySynth(**kwargs), n_notes, blocksize)
+        t_voices = _time_synth(synth.SimplePolySynth(**kwargs), n_notes,
+                               blocksize)
+        print("SimplePolySynth, {} notes, blocks of {}: one synth per note "
+              "{:.0f}% of deadline, voice arrays {:.0f}% of deadline"
+              .format(n_notes, blocksize, 100*t_objects/deadline,
+                      100*t_voices/deadline))
+
+
+class _NestedFMSynth(synth.PolyphonicSynth):
+    """`FMSynth` as it was, with a `OneNoteSynth` modulating another one."""
+    def __init__(self, envelope, envelope_fm, fm_strength, **kwargs):
+        super().__init__(**kwargs)
+        self._envelope, self._envelope_fm = envelope, envelope_fm
+        self._fm_strength = fm_strength
+
+    def create_note(self, note_number, velocity):
+        freq = synth.freq_of_note(note_number)
+        fm = synth.OneNoteSynth(freq, velocity/128, synth.SINE_WAVE,
+                                self._envelope_fm)
+        return synth.OneNoteSynth(freq, velocity/128, synth.SINE_WAVE,
+                                  self._envelope, fm=fm,
+                                  fm_strength=self._fm_strength)
+
+
+def _fm_patch(n_operators, feedback=0.0):
+    """Arguments of FMSynth for stacks of two operators, as the algorithm 5
+    of the DX7, with feedback on the last operator."""
+    operators, modulation = [], np.zeros((n_operators, n_operators))
+    for k in range(0, n_operators, 2):
+        operators += [synth.Operator(1.0, synth.ORGAN_ENVELOPE, 0.5),
+                      synth.Operator(k + 1.0, synth.NO_ENVELOPE)]
+        modulation[k, k+1] = 2.0
+    modulation[-1, -1] = feedback
+    return dict(operators=operators, modulation=modulation)
+
+
+def bench_fm_operators(blocksize=256):
+    """Time to render a block of FM synthesis, compared to the deadline."""
+    deadline = blocksize / synth.SAMPLERATE
+    for n_notes in (10, 16):
+        t_nested = _time_synth(_NestedFMSynth(
+                synth.ORGAN_ENVELOPE, synth.NO_ENVELOPE, fm_strength=5.0,
+                max_polyphony=n_notes), n_notes, blocksize)
+        print("FMSynth, {} notes, 2 operators, blocks of {}: nested synths "
+              "{:.0f}% of deadline".format(n_notes, blocksize,
+                                          100*t_nested/deadline))
+        for n_operators in (2, 4, 6):
+            for feedback in (0.0, 0.5):
+                t_operators = _time_synth(synth.FMSynth(
+                        max_polyphony=n_notes,
+                        **_fm_patch(n_operators, feedback)), n_notes, blocksize)
+                print("FMSynth, {} notes, {} operators{}, blocks of {}: "
+                      "{:.0f}% of deadline".format(
+                              n_notes, n_operators,
+                              " with feedback" if feedback else "", blocksize,
+                              100*t_operators/deadline))
+
+
+class _ObjectCrowdSynthNote(synth.Synth):
+    """`CrowdSynthNote` as it was, with one `OneNoteSynth` per member."""
+    def __init__(self, frequency, volume, *args, nb_synths, freq_width=1/100):
+        frequencies = frequency * (1 + np.random.randn(nb_synths) * freq_width)
+        volumes = volume * np.random.random(nb_synths)
+        volumes /= np.sum(volumes)
+        self._subsynths = [synth.OneNoteSynth(f, v, *args)
+                           for f, v in zip(frequencies, volumes)]
+        self._pannings = np.random.random(nb_synths)*2 - 1.0
+        self.is_alive = True
+
+    def get_data(self, frames):
+        data = np.zeros((frames, 2))
+        for sub, panning in zip(self._subsynths, self._pannings):
+            data += crowd_synth.pan(sub.get_data(frames), panning)
+        self.is_alive = any(sub.is_alive for sub in self._subsynths)
+        return data
+
+    def note_off(self):
+        for sub in self._subsynths:
+            sub.note_off()
+
+
+class _ObjectCrowdSynth(crowd_synth.CrowdSynth):
+    def create_note(self, note_number, velocity):
+        return _ObjectCrowdSynthNote(synth.freq_of_note(note_number),
+                                     velocity/128, self._waveform,
+                                     self._envelope, nb_synths=self._nb_synths)
+
+
+def bench_crowd(blocksize=256, n_notes=10):
+    """Time to render a block of `CrowdSynth` with 10 notes held."""
+    deadline = blocksize / synth.SAMPLERATE
+    kwargs = dict(waveform=synth.OFFSET_TRI_02, envelope=synth.ORGAN_ENVELOPE)
+    t_objects = _time_synth(_ObjectCrowdSynth(nb_synths=50, **kwargs),
+                            n_notes, blocksize, n_blocks=20)
+    print("CrowdSynth, {} notes of 50 synths, one synth per member: "
+          "{:.0f}% of deadline".format(n_notes, 100*t_objects/deadline))
+    for nb_synths in (50, 200, 500):
+        t = _time_synth(crowd_synth.CrowdSynth(nb_synths=nb_synths, **kwargs),
+                        n_notes, blocksize)
+        print("CrowdSynth, {} notes of {} synths: {:.0f}% of deadline"
+              .format(n_notes, nb_synths, 100*t/deadline))
+
+
+def _create_crowd_synth(max_polyphony, nb_synths):
+    """CrowdSynth created by a function of a module, so that worker
+    processes can create it."""
+    return crowd_synth.CrowdSynth(synth.OFFSET_TRI_02, synth.ORGAN_ENVELOPE,
+                                  nb_synths=nb_synths,
+                                  max_polyphony=max_polyphony)
+
+
+def bench_sharded_synth(blocksize=256, nb_synths=200, n_blocks=100):
+    """Time to render a block with the notes split between processes."""
+    import mido
+    from sharded_synth import ShardedSynth
+    deadline = blocksize / synth.SAMPLERATE
+    print("{} cores".format(os.cpu_count()))
+    for n_notes in (0, 10, 40):
+        create = functools.partial(_create_crowd_synth, max(n_notes, 1),
+                                   nb_synths)
+        times = ["one process {:.0f}%".format(
+                100 * _time_synth(create(), n_notes, blocksize, n_blocks)
+                / deadline)]
+        for workers in (1, 2, 4):
+            with ShardedSynth(create, workers, channels=2) as sharded:
+                for note in range(n_notes):
+                    sharded.receive(mido.Message('note_on', note=note,
+                                                 velocity=100))
+                sharded.get_data(blocksize)
+                elapsed = timeit(lambda: [sharded.get_data(blocksize)
+                                          for _ in range(n_blocks)]) / n_blocks
+            times.append("{} workers {:.0f}%".format(workers,
+                                                     100 * elapsed/deadline))
+        print("CrowdSynth, {} notes of {} synths, blocks of {}: {} of "
+              "deadline".format(n_notes, nb_synths, blocksize,
+                                ", ".join(times)))
+
+
+def _aliasing(data, frequency, fs):
+    """Power of data outside of the harmonics of frequency, in dB."""
+    power = np.abs(np.fft.rfft(data * np.hanning(len(data))))**2
+    bins = np.fft.rfftfreq(len(data), 1/fs)
+    harmonics = np.abs(bins/frequency - np.round(bins/frequency)) \
+                    < 4/len(data)*fs/frequency
+    return 10*np.log10(power[~harmonics].sum() / power.sum())
+
+
+def bench_wavetable(voices=300, blocksize=256, frequency=2637.0):
+    """Cost and aliasing of the waveforms, computed directly or from tables."""
+    fs = synth.SAMPLERATE
+    phases = np.random.random((voices, blocksize))
+    frequencies = np.full(voices, frequency)
+    one_second = frequency * np.arange(fs) / fs % 1.0
+    for name in ['SINE_WAVE', 'SAWTOOTH_WAVE', 'SQUARE_WAVE', 'OFFSET_TRI_01']:
+        waveform = getattr(synth, name)
+        table = synth.get_wavetable(waveform)
+        t_direct = timeit(lambda: waveform(phases))
+        t_table = timeit(lambda: table(phases, frequencies))
+        print("{}: direct {:.1f}ns/sample, aliasing {:.0f}dB; "
+              "wavetable {:.1f}ns/sample, aliasing {:.0f}dB"
+              .format(name, t_direct/phases.size*1e9,
+                      _aliasing(waveform(one_second), frequency, fs),
+                      t_table/phases.size*1e9,
+                      _aliasing(table(one_second, frequency), frequency, fs)))
+
+
+def bench_midi_render(filename='Dejected_Groose_piano.mid'):
+    """Real-time factor of rendering a MIDI file to a WAV file offline."""
+    from play_midi_file import render_midi_file
+    synths = {
+        'SimplePolySynth': lambda: synth.SimplePolySynth(
+                synth.OFFSET_TRI_01, synth.ORGAN_ENVELOPE),
+        'FMSynth': lambda: synth.FMSynth(synth.ORGAN_ENVELOPE,
+                                         synth.NO_ENVELOPE, fm_strength=5.0),
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        output = os.path.join(directory, 'rendered.wav')
+        for name, create in synths.items():
+            synth_ = create()
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                duration = render_midi_file(filename, synth_, output)
+            elapsed = time.perf_counter() - start
+            print("Rendering {} with {}: {:.0f}x real time"
+                  .format(filename, name, duration/elapsed))
+
+
+class _LockingPolySynth(synth.SimplePolySynth):
+    """`SimplePolySynth` as it was, changing the voices from the MIDI thread
+    under a lock, and printing every message."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def receive(self, msg, time=None):
+        print(msg)
+        with self._lock:
+            self.handle(msg)
+
+    def _render(self, frames):
+        with self._lock:
+            return super()._render(frames)
+
+
+def _count_overruns(synth_, blocksize=64, duration=2.0, chord=10,
+                    interval=0.05):
+    """Number of blocks rendered after their deadline, out of the total,
+    while another thread plays a chord of `chord` notes every `interval`
+    seconds.
+
+    The blocks are requested at the pace of an audio callback, and a block
+    overruns when it is not ready by the time the next one is requested.
+    """
+    import mido
+    period = blocksize / synth.SAMPLERATE
+    n_blocks = int(duration / period)
+    done = threading.Event()
+
+    def send_messages():
+        notes = 40 + 3 * np.arange(chord)
+        while not done.is_set():
+            for note in notes:
+                synth_.receive(mido.Message('note_on', note=note, velocity=100))
+            time.sleep(interval / 2)
+            for note in notes:
+                synth_.receive(mido.Message('note_off', note=note))
+            time.sleep(interval / 2)
+            notes = (notes - 40 + 5) % 48 + 40
+
+    overruns = 0
+    with contextlib.redirect_stdout(open(os.devnull, 'w')) as devnull, \
+            devnull:
+        sender = threading.Thread(target=send_messages)
+        sender.start()
+        start = time.perf_counter()
+        for k in range(n_blocks):
+            synth_.get_data(blocksize)
+            now = time.perf_counter()
+            deadline = start + (k+1) * period
+            if now > deadline:
+                overruns += 1
+            time.sleep(max(deadline - now, 0))
+        done.set()
+        sender.join()
+    return overruns, n_blocks
+
+
+def bench_message_overruns(blocksize=256):
+    """Callback overruns while MIDI messages arrive from another thread."""
+    kwargs = dict(waveform=synth.OFFSET_TRI_01, envelope=synth.ORGAN_ENVELOPE,
+                  max_polyphony=20)
+    for name, synth_ in [('lock in the callback',
+                          _LockingPolySynth(**kwargs)),
+                         ('message queue', synth.SimplePolySynth(**kwargs))]:
+        overruns, n_blocks = _count_overruns(synth_, blocksize)
+        print("SimplePolySynth, blocks of {}, {}: {} overruns out of {} "
+              "blocks".format(blocksize, name, overruns, n_blocks))
+
+
+LIBRARY_MODULES = ['filters', 'periodfinder', 'yinfinder', 'pitchtrack',
+                   'ringbuffer', 'profiling', 'pitchstream', 'synth',
+                   'crowd_synth', 'sharded_synth', 'pitchserver',
+                   'multipitch']
+HEAVY_MODULES = ['matplotlib', 'scipy.signal', 'scipy.io', 'sounddevice',
+                 'mido']
+
+def _spiky(render, blocksize, every=50, spike=3):
+    """Wrap render, making one call out of `every` last `spike` blocks
+    longer, holding the GIL as a garbage collection would."""
+    calls = 0
+    def spiky_render(frames):
+        nonlocal calls
+        calls += 1
+        if calls % every == 0:
+            end = time.perf_counter() + spike * blocksize / synth.SAMPLERATE
+            while time.perf_counter() < end:
+                pass
+        return render(frames)
+    return spiky_render
+
+
+def _pace_callback(callback, blocksize, duration):
+    """Call callback(out) at the pace of an audio callback, and count the
+    calls which end after the deadline of their block."""
+    period = blocksize / synth.SAMPLERATE
+    out = np.empty(blocksize)
+    late = 0
+    start = time.perf_counter()
+    for k in range(int(duration / period)):
+        delay = start + k*period - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        callback(out)
+        if time.perf_counter() > start + (k+1)*period:
+            late += 1
+    return late
+
+
+def bench_render_ahead(blocksize=256, duration=3.0):
+    """Late blocks with rendering spikes, with and without RenderAhead."""
+    def create():
+        synth_ = synth.SimplePolySynth(synth.OFFSET_TRI_01,
+                                       synth.ORGAN_ENVELOPE)
+        for note in range(60, 70):
+            synth_.note_on(note, 100)
+        return _spiky(synth_.get_data, blocksize)
+
+    render = create()
+    def callback(out):
+        out[:] = render(blocksize)
+    late = _pace_callback(callback, blocksize, duration)
+    print("Rendering in the callback, blocks of {}: {} late blocks out of {}"
+          .format(blocksize, late, int(duration * synth.SAMPLERATE/blocksize)))
+    for blocks_ahead in (2, 4, 8):
+        ahead = synth.RenderAhead(create(), blocksize, blocks_ahead)
+        with ahead:
+            _pace_callback(ahead.read, blocksize, duration)
+        print("Rendering {} blocks ahead ({:.0f}ms of latency): {}".format(
+                blocks_ahead, 1000*ahead.latency, ahead.format_stats()))
+
+
+def bench_import_time():
+    """Time to import each library module in a new interpreter.
+
+    Raises AssertionError if a module imports plotting, scipy or audio
+    libraries before they are needed.
+    """
+    code = ("import sys, time; start = time.perf_counter(); import {}; "
+            "print(time.perf_counter() - start); "
+            "print(' '.join(m for m in {!r} if m in sys.modules))")
+    for module in LIBRARY_MODULES:
+        output = subprocess.run(
+                [sys.executable, '-c', code.format(module, HEAVY_MODULES)],
+                capture_output=True, text=True, check=True).stdout.split('\n')
+        print("import {}: {:.0f}ms".format(module, float(output[0])*1e3))
+        assert not output[1], \
+            "importing {} also imports {}".format(module, output[1])
+
+
+def _synth_runner(create, n_notes, blocksize, n_blocks):
+    """Create a synth holding n_notes different notes, and return a
+    function rendering n_blocks blocks of it.
+
+    Only the rendering is timed: the synth is created, and its notes
+    started, before.
+    """
+    if n_notes > 128:
+        raise ValueError("only 128 different MIDI notes")
+    synth_ = create()
+    first = min(40, 128 - n_notes)
+    for note in range(first, first + n_notes):
+        synth_.note_on(note, 100)
+    synth_.get_data(blocksize)
+    def run():
+        for _ in range(n_blocks):
+            synth_.get_data(blocksize)
+    return run
+
+
+def suite_cases(fs=44100):
+    """The benchmarks of the suite.
+
+    Yields
+    ------
+    name : str, identifying the benchmark in the baselines
+    run : function to time
+    samples : number of samples (frames) processed by run()
+    """
+    duration = 2
+    signals = {'chirp': chirp_signal(duration, fs=fs)[0],
+               'noise': np.random.RandomState(0).randn(duration*fs)}
+    for signal_name, signal in signals.items():
+        for blocksize in (64, 256, 1024):
+            yield ('PeriodFinder/{}/block{}'.format(signal_name, blocksize),
+                   lambda signal=signal, blocksize=blocksize: _run_blocks(
+                           PeriodFinder(fs=fs), signal, blocksize),
+                   len(signal) // blocksize * blocksize)
+        yield ('PeriodFinder/{}/block256/decimation8'.format(signal_name),
+               lambda signal=signal: _run_blocks(
+                       PeriodFinder(fs=fs, decimation=8), signal, 256),
+               len(signal) // 256 * 256)
+
+    signal = signals['noise']
+    for blocksize in (64, 256, 1024, 8192):
+        filt = filters.bandpass_and_integrate(fs=fs)
+        out = np.empty(blocksize)
+        blocks = [signal[k:k+blocksize]
+                  for k in range(0, len(signal) - blocksize + 1, blocksize)]
+        yield ('Filter/block{}'.format(blocksize),
+               lambda filt=filt, out=out, blocks=blocks:
+                   [filt(block, out=out) for block in blocks],
+               len(blocks) * blocksize)
+
+    blocksize, n_blocks = 256, 50
+    for n_notes in (1, 10, 100):
+        yield ('SimplePolySynth/notes{}'.format(n_notes),
+               _synth_runner(lambda n=n_notes: synth.SimplePolySynth(
+                       synth.OFFSET_TRI_01, synth.ORGAN_ENVELOPE,
+                       max_polyphony=n), n_notes, blocksize, n_blocks),
+               n_blocks * blocksize)
+        yield ('FMSynth/notes{}'.format(n_notes),
+               _synth_runner(lambda n=n_notes: synth.FMSynth(
+                       synth.ORGAN_ENVELOPE, synth.NO_ENVELOPE,
+                       fm_strength=5.0, max_polyphony=n),
+                       n_notes, blocksize, n_blocks),
+               n_blocks * blocksize)
+    for n_operators in (4, 6):
+        yield ('FMSynth/operators{}/notes10'.format(n_operators),
+               _synth_runner(lambda n=n_operators: synth.FMSynth(
+                       max_polyphony=10, **_fm_patch(n, feedback=0.5)),
+                       10, blocksize, n_blocks),
+               n_blocks * blocksize)
+    for n_notes, nb_synths in [(1, 50), (10, 50), (10, 200)]:
+        yield ('CrowdSynth/notes{}/synths{}'.format(n_notes, nb_synths),
+               _synth_runner(lambda n=n_notes, nb=nb_synths:
+                       crowd_synth.CrowdSynth(
+                               synth.OFFSET_TRI_02, synth.ORGAN_ENVELOPE,
+                               nb_synths=nb, max_polyphony=n),
+                       n_notes, blocksize, n_blocks),
+               n_blocks * blocksize)
+
+
+def run_suite(fs=44100, repeat=3):
+    """Run the benchmark suite.
+
+    Yields one dict per benchmark, with its name, the best time in seconds,
+    the samples processed per second, and the real-time factor.
+    """
+    for name, run, samples in suite_cases(fs):
+        elapsed = timeit(run, repeat)
+        yield dict(name=name, seconds=elapsed,
+                   samples_per_second=samples/elapsed,
+                   realtime_factor=samples/fs/elapsed)
+
+
+def read_results(filename):
+    """Read the results written by `python benchmarks.py --suite -o`,
+    as a dict from the names of the benchmarks to their results."""
+    with open(filename) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    return {result['name']: result for result in results}
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Compare results to a baseline.
+
+    results, baseline : dicts from names to results, as `read_results`
+    tolerance : relative slowdown tolerated before reporting a regression
+
+    Returns
+    -------
+    regressions : list of the names of the benchmarks slower than their
+        baseline by more than the tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['samples_per_second'] \
+                / baseline[name]['samples_per_second']
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+        print("{:<32} {:>8.1f}x real time, {:>6.0%} of baseline{}"
+              .format(name, result['realtime_factor'], ratio,
+                      "  REGRESSION" if ratio < 1 - tolerance else ""),
+              file=sys.stderr)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Benchmarks of the pitch detector and the synths.")
+    parser.add_argument('--suite', action='store_true',
+                        help="Only run the benchmark suite, and print its "
+                             "results as JSON lines")
+    parser.add_argument('-o', '--output',
+                        help="With --suite, also write the results to this "
+                             "file, to use as a baseline")
+    parser.add_argument('--baseline',
+                        help="With --suite, compare the results to the ones "
+                             "of this file")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Relative slowdown reported as a regression "
+                             "(default 0.2)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="Times each benchmark of the suite is run, "
+                             "keeping the best (default 3)")
+    args = parser.parse_args(argv)
+
+    if not args.suite:
+        bench_periodfinder_loop()
+        bench_periodfinder_bank()
+        bench_estimators()
+        bench_silence_gate()
+        bench_decimation()
+        bench_multipitch()
+        bench_filter_design()
+        bench_filter_inplace()
+        bench_polyphony()
+        bench_fm_operators()
+        bench_crowd()
+        bench_sharded_synth()
+        bench_wavetable()
+        bench_midi_render()
+        bench_message_overruns()
+        bench_render_ahead()
+        bench_import_time()
+        return 0
+
+    results = {}
+    for result in run_suite(repeat=args.repeat):
+        print(json.dumps(result), flush=True)
+        results[result['name']] = result
+    if args.output:
+        with open(args.output, 'w') as f:
+            for result in results.values():
+                f.write(json.dumps(result) + '\n')
+    if args.baseline:
+        regressions = compare_results(results, read_results(args.baseline),
+                                      args.tolerance)
+        if regressions:
+            print("{} regressions: {}".format(len(regressions),
+                                               ', '.join(regressions)),
+                  file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,43 +7,63 @@ Created on Thu Dec 26 18:56:18 2019
 import numpy as np
 from numpy.random import randn, random
 
-from synth import (Synth, OneNoteSynth, SAMPLERATE, PolyphonicSynth,
-                   freq_of_note, OFFSET_TRI_02, ORGAN_ENVELOPE)
+from synth import (Synth, EnvelopeGain, SAMPLERATE, PolyphonicSynth,
+                   Wavetable, get_wavetable, freq_of_note, OFFSET_TRI_02,
+                   ORGAN_ENVELOPE, RenderAhead)
 
 class CrowdSynthNote(Synth):
-    """Simulate a crowd of synths with randomized volumes/pitches."""
-    def __init__(self, frequency, volume, *args,
-                 nb_synths, freq_width=1/100,
-                 **kwargs):
-        frequencies = frequency * (1 + randn(nb_synths) * freq_width)
+    """Simulate a crowd of synths with randomized volumes/pitches.
+
+    All the synths of the crowd share the same envelope, and are rendered
+    together as a (nb_synths, frames) array.
+    """
+    def __init__(self, frequency, volume, waveform, envelope,
+                 nb_synths, freq_width=1/100):
+        self._frequencies = frequency * (1 + randn(nb_synths) * freq_width)
 #        frequencies = frequency * \
 #                        (1 + np.linspace(-1, 1, nb_synths)*freq_width)
         volumes = volume * random(nb_synths)
         volumes /= np.sum(volumes)
-        self._subsynths = [OneNoteSynth(f, v, *args, **kwargs)
-                            for f, v in zip(frequencies, volumes)]
-        self._pannings = random(nb_synths)*2 - 1.0
+        pannings = random(nb_synths)*2 - 1.0
+        # Gain of each synth in each stereo channel, shape (nb_synths, 2)
+        self._gains = volumes[:, np.newaxis] * pan_gains(pannings)
+        self._phases = np.zeros(nb_synths) # normalized, in [0, 1)
+        self._waveform = waveform
+        self._envelope = EnvelopeGain(envelope)
         self.is_alive = True
 
     def get_data(self, frames):
         """Returns stereo data"""
-        data = np.zeros((frames, 2))
-        for sub, panning in zip(self._subsynths, self._pannings):
-            data += pan(sub.get_data(frames), panning)
-        self.is_alive = any(sub.is_alive for sub in self._subsynths)
+        phases = np.multiply.outer(self._frequencies,
+                                   np.arange(1, frames+1)/SAMPLERATE)
+        phases += self._phases[:, np.newaxis]
+        phases -= np.floor(phases)
+        if frames:
+            self._phases = phases[:, -1]
+        if isinstance(self._waveform, Wavetable):
+            waves = self._waveform(phases, self._frequencies)
+        else:
+            waves = self._waveform(phases)
+        data = waves.T @ self._gains
+        data *= self._envelope.get_gain(frames)[:, np.newaxis]
+        self.is_alive = self._envelope.is_alive
         return data
 
     def note_off(self):
-        for sub in self._subsynths:
-            sub.note_off()
+        self._envelope.note_off()
 
 class CrowdSynth(PolyphonicSynth):
     def __init__(self, waveform, envelope,
-                 nb_synths=50, **kwargs):
+                 nb_synths=50, wavetable=False, **kwargs):
         super().__init__(**kwargs)
+        if wavetable:
+            waveform = get_wavetable(waveform)
         self._waveform, self._envelope = waveform, envelope
         self._nb_synths = nb_synths
 
+    def _silence(self, frames):
+        return np.zeros((frames, 2))
+
     def create_note(self, note_number, velocity):
         return CrowdSynthNote(freq_of_note(note_number), velocity/128,
                                   self._waveform, self._envelope,
@@ -54,6 +74,21 @@ CROWD_SYNTH = CrowdSynth(OFFSET_TRI_02, ORGAN_ENVELOPE)
 
 
 
+def pan_gains(panning=0.0):
+    """Gains of the left and right channels for a given panning.
+
+    panning : float in [-1.0, 1.0], or array of such floats
+        Left is -1.0, right is 1.0
+
+    Returns
+    -------
+    gains : array of shape (2,), or (len(panning), 2)
+    """
+    panning = np.clip(panning, -1.0, 1.0)
+    left_gain = (1-panning)/2
+    right_gain = 1-left_gain
+    return np.stack((left_gain, right_gain), axis=-1)
+
 def pan(data, panning=0.0):
     """Convert mono data to stereo with panning.
 
@@ -67,29 +102,47 @@ def pan(data, panning=0.0):
     """
     frames = len(data)
     assert data.shape == (frames,)
-    panning = max(-1.0, min(panning, 1.0)) # Clip to [-1.0, 1.0]
-
-    left_gain = (1-panning)/2
-    right_gain = 1-left_gain
-    out_data = np.zeros((frames, 2))
-    out_data[:, 0] = left_gain * data
-    out_data[:, 1] = right_gain * data
-    return out_data
+    return np.outer(data, pan_gains(panning))
 
 
 if __name__ == '__main__':
+    import argparse
+    import contextlib
     import time
     import sounddevice as sd
     import mido
+    from profiling import CallbackProfiler
 
+    parser = argparse.ArgumentParser(
+            description="Play the notes of the default MIDI input.")
+    parser.add_argument('--ahead', type=int, default=0, metavar='BLOCKS',
+                        help="Render this number of blocks of 256 frames "
+                             "ahead of the audio callback, in another "
+                             "thread (default 0, render in the callback)")
+    args = parser.parse_args()
 
     synth = CROWD_SYNTH
+    get_data = CallbackProfiler(synth.get_data)
+    get_data.start_reporting(interval=10.0)
+    ahead = RenderAhead(get_data, 256, args.ahead, channels=2) \
+                if args.ahead else None
 
     def callback(indata, outdata, frames, time, status):
-        outdata[:] = synth.get_data(frames)
-
-    with sd.Stream(samplerate=SAMPLERATE, channels=2, callback=callback):
+        get_data.count_status(status)
+        if ahead is None:
+            outdata[:] = get_data(frames)
+        else:
+            ahead.read(outdata)
+
+    with ahead or contextlib.nullcontext(), \
+            sd.Stream(samplerate=SAMPLERATE, channels=2, callback=callback):
         with mido.open_input() as inport:
             inport.callback = synth.receive
-            while not inport.closed:
-                time.sleep(0.1)
+            try:
+                while not inport.closed:
+                    time.sleep(0.1)
+            finally:
+                get_data.stop_reporting()
+                print("Total:", get_data.format_stats())
+                if ahead is not None:
+                    print(ahead.format_stats())
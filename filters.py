@@ -5,9 +5,12 @@ author: Alexis THIBAULT
 """
 
 
+import ast
+import collections
+import functools
+import inspect
+
 import numpy as np
-import scipy.signal as ssi
-import matplotlib.pyplot as plt
 
 class Filter:
     """A digital filter, to be applied to a digital signal.
@@ -18,41 +21,260 @@ class Filter:
 
     You should call filter_(signal) where signal is array-like and sampled at fs.
     Should be a morphism for concatenation : concat(filter_(a), filter_(b)) is close to filter_(concat(a,b))
+
+    If `channels` is given, signal should be of shape (frames, channels),
+    and each channel is filtered independently.
     """
 
-    def __init__(self, sos):
-        self.sos = sos
+    def __init__(self, sos, channels=None):
+        self.sos = np.ascontiguousarray(sos, dtype=float)
+        self.channels = channels
         self.reset()
 
     def reset(self):
-        self._z_values = np.zeros((self.sos.shape[0], 2))
+        n_sections = self.sos.shape[0]
+        if self.channels is None:
+            self._z_values = np.zeros((n_sections, 2))
+        else:
+            # Laid out in memory as (channels, sections, 2), for _sosfilt_kernel
+            self._z_values = np.zeros((self.channels, n_sections, 2)) \
+                               .transpose(1, 2, 0)
+
+    def __call__(self, indata, out=None):
+        """Filter indata.
+
+        If `out` is given, the filtered data is written to it and returned.
+        If `out` is a float array, contiguous along time (Fortran order for
+        several channels), nothing is allocated, which keeps the cost of
+        small blocks low. `out` may be indata itself.
+        """
+        kernel = _sosfilt_kernel()
+        if out is not None and kernel is not None \
+                and out.dtype == np.float64 and out.T.flags.c_contiguous:
+            if out is not indata:
+                out[...] = indata
+            # Both the data and the state are updated in place
+            z_values = self._z_values if self.channels is None \
+                            else self._z_values.transpose(2, 0, 1)
+            try:
+                kernel(self.sos, out.T.reshape(-1, len(out)),
+                       z_values.reshape(-1, self.sos.shape[0], 2))
+                return out
+            except (TypeError, ValueError):
+                # The kernel rejects arguments it accepted when checked:
+                # the kernel checks its arguments before filtering, so the
+                # data and the state are untouched
+                pass
+
+        # Imported here, so that importing this module stays fast
+        import scipy.signal as ssi
+        outdata, self._z_values[...] = ssi.sosfilt(self.sos,
+                                                  indata,
+                                                  axis=0,
+                                                  zi=self._z_values)
+        if out is None:
+            return outdata
+        out[...] = outdata
+        return out
+
+    def filter_channels(self, indata, channels, out=None):
+        """Filter only some of the channels, as __call__.
+
+        indata : array of shape (frames, len(channels))
+        channels : indices of the channels of indata
+        The state of the other channels is left unchanged, as if they were
+        not part of the signal.
+        """
+        z_values = self._z_values
+        # Laid out as (channels, sections, 2), like the state of all channels
+        self._z_values = np.ascontiguousarray(
+                z_values[..., channels].transpose(2, 0, 1)).transpose(1, 2, 0)
+        try:
+            return self(indata, out)
+        finally:
+            z_values[..., channels] = self._z_values
+            self._z_values = z_values
+
+
+@functools.lru_cache(maxsize=None)
+def _sosfilt_kernel():
+    """The in-place filtering function used by scipy's sosfilt, if available.
+
+    It is private to scipy, so it is only used if it gives the same results
+    as sosfilt, with the arguments and layout of Filter.__call__.
+    """
+    try:
+        from scipy.signal._sosfilt import _sosfilt
+    except ImportError:
+        return None
+    import scipy.signal as ssi
+    rng = np.random.default_rng(0)
+    sos = ssi.butter(4, 0.1, output='sos')
+    x = rng.standard_normal((2, 32))
+    zi = rng.standard_normal((2, 2, 2))
+    expected, expected_zi = ssi.sosfilt(sos, x, axis=1,
+                                        zi=zi.transpose(1, 0, 2))
+    try:
+        _sosfilt(sos, x, zi)
+    except (TypeError, ValueError):
+        return None
+    if not (np.allclose(x, expected)
+            and np.allclose(zi, expected_zi.transpose(1, 0, 2))):
+        return None
+    return _sosfilt
 
-    def __call__(self, indata):
-        outdata, self._z_values = ssi.sosfilt(self.sos,
-                                             indata,
-                                             zi=self._z_values)
-        return outdata
+
+def accepting_out(filt):
+    """filt, or a wrapper of it, which can be called as filt(indata, out=out).
+
+    Filters given to PeriodFinder are called with `out`, as Filter. Other
+    callables taking only indata are wrapped, and their result is copied
+    into `out`.
+    """
+    try:
+        parameters = inspect.signature(filt).parameters.values()
+    except (TypeError, ValueError):
+        parameters = []
+    if any(p.name == 'out' or p.kind == p.VAR_KEYWORD for p in parameters):
+        return filt
+
+    @functools.wraps(filt)
+    def filt_with_out(indata, out=None):
+        outdata = filt(indata)
+        if out is None:
+            return outdata
+        out[...] = outdata
+        return out
+    return filt_with_out
+
+
+
+class Decimator:
+    """A low-pass FIR filter, followed by a decimation.
+
+    Only one sample out of `factor` is kept, and only the samples kept are
+    computed, so that it costs about numtaps/factor multiplications per
+    sample of input. As for a Filter, in case of sequential calls the
+    decimator behaves as if the signals were concatenated: the samples kept
+    are those whose index in the whole signal is a multiple of `factor`.
+    """
+
+    def __init__(self, factor, fs=44100, numtaps=None, cutoff=None):
+        """
+        Parameters
+        ----------
+        factor : int, decimation factor
+        fs : sampling frequency before decimation
+        numtaps : length of the anti-aliasing filter, by default 8*factor
+        cutoff : cutoff frequency of the anti-aliasing filter, by default
+            the Nyquist frequency after decimation
+        """
+        if numtaps is None:
+            numtaps = 8 * factor
+        if cutoff is None:
+            cutoff = fs / (2*factor)
+        # Windowed sinc, reversed to be applied to sliding windows of data
+        n = np.arange(numtaps) - (numtaps-1)/2
+        taps = np.sinc(2*cutoff/fs * n) * np.hamming(numtaps)
+        self._taps = taps[::-1] / taps.sum()
+        self.factor = factor
+        # The last numtaps-1 samples of the previous block, then the block
+        self._buffer = np.zeros(numtaps - 1)
+        self.reset()
+
+    def reset(self):
+        self._buffer[:len(self._taps)-1] = 0.0
+        self.offset = 0 # index in the next block of its first sample kept
+
+    def output_length(self, frames):
+        """Number of samples kept from the next `frames` samples."""
+        return max(0, -(-(frames - self.offset) // self.factor))
+
+    def skip(self, frames):
+        """Skip `frames` samples, as if they were decimated."""
+        self.offset = (self.offset - frames) % self.factor
+
+    def __call__(self, indata, out=None):
+        """Filter and decimate indata, an array of shape (frames,).
+
+        If `out` is given, of length `output_length(len(indata))`, the
+        decimated data is written to it and returned.
+        """
+        n_taps, frames = len(self._taps), len(indata)
+        if len(self._buffer) < n_taps - 1 + frames:
+            buffer = np.empty(n_taps - 1 + frames)
+            buffer[:n_taps-1] = self._buffer[:n_taps-1]
+            self._buffer = buffer
+        data = self._buffer[:n_taps-1+frames]
+        data[n_taps-1:] = indata
+        # Row k of windows ends with indata[offset + k*factor]
+        step = data.strides[0]
+        windows = np.ndarray((self.output_length(frames), n_taps),
+                             buffer=data, offset=self.offset*step,
+                             strides=(self.factor*step, step))
+        out = np.einsum('ij,j->i', windows, self._taps, out=out)
+        self._buffer[:n_taps-1] = data[frames:]
+        self.skip(frames)
+        return out
+
+
+
+### ---------- Filter design ---------------------------------
+
+SOS_CACHE_SIZE = 256
+_sos_cache = collections.OrderedDict()
+
+def design_sos(order, cutoff, btype, fs=44100):
+    """Second-order sections of a Butterworth filter.
+
+    The designs are kept in a LRU cache of `SOS_CACHE_SIZE` entries,
+    so that designing the same filter again only costs a copy.
+    """
+    key = (btype, int(order),
+           tuple(float(f) for f in np.atleast_1d(cutoff)), float(fs))
+    try:
+        _sos_cache.move_to_end(key)
+    except KeyError:
+        import scipy.signal as ssi
+        _sos_cache[key] = ssi.iirfilter(order, cutoff, btype=btype, fs=fs,
+                                        output='sos')
+        while len(_sos_cache) > SOS_CACHE_SIZE:
+            _sos_cache.popitem(last=False)
+    return _sos_cache[key].copy()
+
+def save_sos_cache(filename):
+    """Save the designed filters to a .npz file."""
+    np.savez(filename, **{repr(key): sos for key, sos in _sos_cache.items()})
+
+def load_sos_cache(filename):
+    """Add the designed filters saved with `save_sos_cache` to the cache."""
+    with np.load(filename) as saved:
+        for name in saved.files:
+            _sos_cache[ast.literal_eval(name)] = saved[name]
+    while len(_sos_cache) > SOS_CACHE_SIZE:
+        _sos_cache.popitem(last=False)
 
 
 
 ### ---------- Factory functions ---------------------------
 
-def lowpass_filter(fc, order=6, fs=44100):
-    sos = ssi.butter(order, fc, btype='lowpass', fs=fs, output='sos')
-    return Filter(sos)
+def lowpass_filter(fc, order=6, fs=44100, channels=None):
+    sos = design_sos(order, fc, 'lowpass', fs)
+    return Filter(sos, channels)
 
-def bandpass_filter(f_low=50, f_high=1000, order=6, fs=44100):
-    sos = ssi.iirfilter(order, (f_low, f_high), btype='band', fs=fs, output='sos')
-    return Filter(sos)
+def bandpass_filter(f_low=50, f_high=1000, order=6, fs=44100, channels=None):
+    sos = design_sos(order, (f_low, f_high), 'bandpass', fs)
+    return Filter(sos, channels)
 
-def bandpass_and_integrate(f_low=50, f_high=1000, order=6, fs=44100):
+def bandpass_and_integrate(f_low=50, f_high=1000, order=6, fs=44100,
+                           channels=None):
     """Create a filter that is a combination of a band-pass of order `order`
     and a low-pass of order 2.
     """
-    sos_1 = ssi.iirfilter(order, (f_low, f_high), btype='band', fs=fs, output='sos')
-    sos_2 = ssi.iirfilter(2, f_low, btype='low', fs=fs, output='sos')
+    sos_1 = design_sos(order, (f_low, f_high), 'bandpass', fs)
+    sos_2 = design_sos(2, f_low, 'lowpass', fs)
     sos = np.concatenate((sos_1, sos_2), axis=0)
-    return Filter(sos)
+    return Filter(sos, channels)
 
 
 
@@ -61,6 +283,8 @@ def bandpass_and_integrate(f_low=50, f_high=1000, order=6, fs=44100):
 ### ------------------- Test that it works properly ---------------------------
 
 if __name__ == '__main__':
+    import scipy.signal as ssi
+    import matplotlib.pyplot as plt
 
     def test_filter(filt, f0=20, f1=20000):
         t = np.arange(0, 5, 1/44100)
@@ -84,9 +308,58 @@ if __name__ == '__main__':
         # Morphism for concatenation
         assert np.allclose(np.concatenate((filtered1, filtered2)), filtered)
 
+        # Filtering in place gives the same result
+        filt.reset()
+        out = np.empty(256)
+        filtered3 = [filt(chirp[k:k+256], out=out).copy()
+                     for k in range(0, len(chirp) - 255, 256)]
+        assert np.allclose(np.concatenate(filtered3), filtered[:256*len(filtered3)])
+
+    # Without scipy's kernel, or when it rejects its arguments, sosfilt is
+    # used instead, with the same results
+    def rejecting_kernel(sos, x, zi):
+        raise TypeError("wrong arguments")
+    kernel = _sosfilt_kernel
+    for replacement in (None, rejecting_kernel):
+        _sosfilt_kernel = lambda: replacement
+        test_filter(bandpass_and_integrate())
+    _sosfilt_kernel = kernel
+    assert _sosfilt_kernel() is not None
+
     test_filter(lowpass_filter(1000, 6))
     test_filter(lowpass_filter(250))
     test_filter(bandpass_filter())
     test_filter(bandpass_and_integrate())
 
+    # Multi-channel filters behave like one filter per channel
+    stereo = np.random.randn(44100, 2)
+    filtered = bandpass_and_integrate(channels=2)(stereo)
+    assert np.allclose(filtered[:, 0], bandpass_and_integrate()(stereo[:, 0]))
+    assert np.allclose(filtered[:, 1], bandpass_and_integrate()(stereo[:, 1]))
+    filt = bandpass_and_integrate(channels=2)
+    out = np.empty((256, 2), order='F')
+    filtered2 = [filt(stereo[k:k+256], out=out).copy()
+                 for k in range(0, len(stereo) - 255, 256)]
+    assert np.allclose(np.concatenate(filtered2), filtered[:256*len(filtered2)])
+
+
+
+    # Filtering some channels leaves the others as they were
+    filt = bandpass_and_integrate(channels=3)
+    three = np.random.randn(1000, 3)
+    first = filt(three[:500])
+    second = filt.filter_channels(three[500:, [0, 2]], [0, 2])
+    third = filt(three)
+    assert np.allclose(second, bandpass_and_integrate(channels=2)(
+            three[:, [0, 2]])[500:])
+    assert np.allclose(third[:, 1], bandpass_and_integrate()(
+            np.concatenate((three[:500, 1], three[:, 1])))[500:])
 
+    # Decimating by blocks keeps the same samples as decimating at once
+    signal = np.random.randn(44100)
+    decimator = Decimator(8)
+    decimated = decimator(signal)
+    decimator.reset()
+    blocks = [decimator(signal[k:k+100]) for k in range(0, len(signal), 100)]
+    assert np.allclose(np.concatenate(blocks), decimated)
+    assert len(decimated) == -(-len(signal) // 8)
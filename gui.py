@@ -9,11 +9,31 @@ Created on Mon Nov 18 21:15:55 2019
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
-import collections
+
+from pitchstream import PitchStream
 
 class PitchGUI:
-    def __init__(self, fs=44100, blocksize=256, persistence=0.1):
-        self.freqs = collections.deque([], int(persistence*fs/blocksize))
+    def __init__(self, stream=None, fs=44100, blocksize=256, persistence=0.1,
+                 display_rate=200):
+        """
+        stream : PitchStream whose estimates are displayed. If None, the
+            GUI has its own stream, fed by give_frequency.
+        fs, blocksize : time between two calls to give_frequency
+        persistence : time during which each estimate is displayed, in s
+        display_rate : maximal number of estimates displayed per second
+        """
+        if stream is None:
+            stream = PitchStream()
+            stream.start()
+        self.stream = stream
+        self._subscription = stream.subscribe(rate=display_rate)
+        self._persistence = persistence
+        self._block_duration = blocksize / fs
+        self._blocks_given = 0
+        # Estimates being displayed, and their positions on the circle
+        self._times = np.zeros(0)
+        self._xx = np.zeros(0)
+        self._yy = np.zeros(0)
         self._init_plot()
         
     def _init_plot(self):
@@ -38,19 +58,39 @@ class PitchGUI:
             self.ax.annotate(name, (ct, st), (ct*1.2, st*1.2))
             
         
-    def _create_points(self):
-        freqs = np.array(self.freqs)
+    def _create_points(self, freqs):
         notes = 12 * np.log2(freqs/440)
         theta = 2*np.pi / 12 * notes
         xx = np.cos(theta)
         yy = np.sin(theta)
         return xx, yy
-    
+
     def give_frequency(self, f):
-        self.freqs.append(f)
-        
+        """Display a frequency, estimated on the next block of audio.
+
+        Only for a GUI without a stream given at creation."""
+        self._blocks_given += 1
+        self.stream.publish(self._blocks_given * self._block_duration, f)
+
+    def _update_points(self):
+        """Add the new estimates, and forget the ones that are too old.
+
+        Only the positions of the new estimates are computed."""
+        events = self._subscription.get_all()
+        if len(events) == 0:
+            return False
+        start = events[-1, 0] - self._persistence
+        events = events[events[:, 0] > start]
+        xx, yy = self._create_points(events[:, 1])
+        keep = self._times > start
+        self._times = np.concatenate((self._times[keep], events[:, 0]))
+        self._xx = np.concatenate((self._xx[keep], xx))
+        self._yy = np.concatenate((self._yy[keep], yy))
+        return True
+
     def animate(self, frame):
-        self._points.set_data(*self._create_points())
+        if self._update_points():
+            self._points.set_data(self._xx, self._yy)
         return self._points,
     
     
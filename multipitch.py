@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Polyphonic pitch detection, by harmonic summation on short-time spectra.
+
+Overlapping frames are windowed and transformed by batches, in buffers
+allocated once. The salience of each candidate fundamental is a weighted sum
+of the spectrum at its harmonics, computed for all the candidates and all
+the frames of a batch by one matrix product. The most salient fundamental
+is kept, its harmonics are removed from the spectrum, and so on until
+`n_pitches` fundamentals are found in each frame, or the next is not salient
+enough.
+
+Reference: A. Klapuri, "Multiple fundamental frequency estimation by summing
+harmonic amplitudes", ISMIR 2006.
+"""
+import numpy as np
+
+
+# np.fft can write its result to a given array since numpy 2.0
+_FFT_OUT = np.lib.NumpyVersion(np.__version__) >= '2.0.0'
+
+
+class MultiPitchFinder:
+    def __init__(self, fs=44100, n_pitches=4, frame_size=4096, hop=512,
+                 f_min=50, f_max=1000, n_harmonics=8, threshold=0.2,
+                 gate_level=1e-3, batch=64):
+        """
+        Parameters
+        ----------
+        fs : sampling frequency
+        n_pitches : maximal number of fundamentals found in each frame
+        frame_size : number of samples of each frame
+        hop : number of samples between two frames
+        f_min, f_max : range of the detected fundamentals
+        n_harmonics : number of harmonics summed for each fundamental
+        threshold : minimal salience of a fundamental, relative to the most
+            salient one of its frame
+        gate_level : RMS level below which a frame is considered silent
+        batch : maximal number of frames transformed at once
+        """
+        self._fs = fs
+        self.n_pitches = n_pitches
+        self.frame_size = frame_size
+        self.hop = hop
+        self._threshold = threshold
+        self._gate_level = gate_level
+        self._batch = batch
+
+        # Buffers, zero-padded to twice the frame size
+        self._nfft = 2 * frame_size
+        self._window = np.hanning(frame_size)
+        self._window *= 2 / self._window.sum() # sines of amplitude 1 -> 1
+        self._frames = np.zeros((batch, self._nfft))
+        self._spectrum = np.empty((batch, self._nfft//2 + 1), dtype=complex)
+        self._n_bins = min(int(np.ceil(n_harmonics * f_max * self._nfft / fs))
+                           + 2, self._nfft//2 + 1)
+        self._magnitude = np.empty((batch, self._n_bins))
+
+        # Candidates every 1/5 of a semitone, and the weights of their
+        # harmonics in the spectrum, interpolated between bins
+        self._step = 2**(1/60)
+        n_candidates = int(np.log(f_max/f_min) / np.log(self._step)) + 1
+        self._candidates = f_min * self._step**np.arange(n_candidates)
+        self._harmonics = np.arange(1, n_harmonics + 1)
+        positions = np.multiply.outer(self._harmonics, self._candidates) \
+                    * self._nfft / fs
+        below = positions.astype(int)
+        fraction = positions - below
+        weights = np.zeros((self._n_bins, n_candidates))
+        for h, weight in enumerate(1 / self._harmonics):
+            inside = below[h] + 1 < self._n_bins
+            columns = np.arange(n_candidates)[inside]
+            weights[below[h, inside], columns] += weight * (1-fraction[h, inside])
+            weights[below[h, inside]+1, columns] += weight * fraction[h, inside]
+        self._weights = weights
+        # Bins removed around each harmonic of a fundamental found: the main
+        # lobe of the window is 4 bins wide on each side
+        self._lobe = np.arange(-4, 5)
+        # Candidates within a semitone of a fundamental found
+        self._near = np.arange(-5, 6)
+
+        self._history = np.zeros(frame_size - 1)
+        self._samples_seen = 0
+        self.frequencies = np.full(n_pitches, np.nan)
+        self.saliences = np.zeros(n_pitches)
+
+    def __call__(self, indata):
+        """Analyze indata, and return the fundamentals of the last frame.
+
+        Returns an array of n_pitches frequencies in Hz, from the most to the
+        least salient, with nan where fewer fundamentals are found.
+        """
+        self.analyze(indata)
+        return self.frequencies
+
+    def analyze(self, indata):
+        """Analyze indata, which follows the data of the previous calls.
+
+        This is the same for a block of a live stream and for a whole file:
+        a frame ends every `hop` samples since the beginning of the stream,
+        and all the frames ending in indata are analyzed, by batches.
+
+        Returns
+        -------
+        frequencies : array of shape (frames, n_pitches), in Hz
+            Fundamentals of each frame ending in indata, from the most to
+            the least salient, nan where fewer are found.
+        saliences : array of shape (frames, n_pitches)
+            Harmonic sums of these fundamentals, 0 where none is found.
+        """
+        data = np.concatenate((self._history, indata))
+        # Frame k of windows ends with sample k of indata
+        windows = np.lib.stride_tricks.sliding_window_view(data,
+                                                           self.frame_size)
+        first = -(self._samples_seen + 1) % self.hop
+        windows = windows[first::self.hop]
+        self._history = data[len(data) - (self.frame_size - 1):]
+        self._samples_seen += len(indata)
+
+        frequencies = np.full((len(windows), self.n_pitches), np.nan)
+        saliences = np.zeros((len(windows), self.n_pitches))
+        for start in range(0, len(windows), self._batch):
+            stop = min(start + self._batch, len(windows))
+            self._analyze_frames(windows[start:stop],
+                                 frequencies[start:stop], saliences[start:stop])
+        if len(windows):
+            self.frequencies, self.saliences = frequencies[-1], saliences[-1]
+        return frequencies, saliences
+
+    def frame_times(self, n_frames):
+        """Time of the end of the last n_frames frames analyzed, in seconds."""
+        last = self._samples_seen // self.hop
+        return np.arange(last - n_frames + 1, last + 1) * self.hop / self._fs
+
+    def _analyze_frames(self, windows, frequencies, saliences):
+        """Find the fundamentals of frames, into frequencies and saliences."""
+        n = len(windows)
+        frames = self._frames[:n]
+        np.multiply(windows, self._window, out=frames[:, :self.frame_size])
+        if _FFT_OUT:
+            spectrum = np.fft.rfft(frames, axis=1, out=self._spectrum[:n])
+        else:
+            spectrum = np.fft.rfft(frames, axis=1)
+        magnitude = np.abs(spectrum[:, :self._n_bins], out=self._magnitude[:n])
+        levels = np.sqrt(np.einsum('ij,ij->i', windows, windows)
+                         / self.frame_size)
+        active = levels >= self._gate_level
+
+        rows = np.arange(n)[:, np.newaxis]
+        found = np.empty((n, 0), dtype=int) # candidates near those found
+        for k in range(self.n_pitches):
+            salience = magnitude @ self._weights
+            salience[rows, found] = 0.0 # found fundamentals are not found again
+            best = np.argmax(salience, axis=1)
+            peak = salience[np.arange(n), best]
+            if k == 0:
+                first_peak = peak
+            else:
+                active &= peak >= self._threshold * first_peak
+            if not active.any():
+                break
+            # Parabolic interpolation between candidates
+            inner = np.clip(best, 1, salience.shape[1] - 2)
+            y0, y1, y2 = (salience[np.arange(n), inner + d] for d in (-1, 0, 1))
+            curvature = y0 - 2*y1 + y2
+            with np.errstate(invalid='ignore', divide='ignore'):
+                shift = np.where(curvature < 0, (y0 - y2) / (2*curvature), 0.0)
+            f0 = self._candidates[inner] * self._step**np.clip(
+                    shift + (best - inner), -1, 1)
+            frequencies[active, k] = f0[active]
+            saliences[active, k] = peak[active]
+            self._remove_harmonics(magnitude, f0)
+            found = np.hstack((found, np.clip(best[:, np.newaxis] + self._near,
+                                              0, salience.shape[1] - 1)))
+
+    def _remove_harmonics(self, magnitude, f0):
+        """Remove the harmonics of fundamentals from magnitude spectra.
+
+        Only the part of each harmonic under the mean of its neighbours is
+        removed, so that the harmonics of another note at the same
+        frequency are left (spectral smoothness, as in Klapuri's paper).
+        """
+        n = len(f0)
+        rows = np.arange(n)[:, np.newaxis]
+        bins = np.rint(np.multiply.outer(f0, self._harmonics)
+                       * self._nfft / self._fs).astype(int)
+        np.clip(bins, 0, self._n_bins - 1, out=bins)
+        amplitudes = magnitude[rows, bins]
+        padded = np.pad(amplitudes, ((0, 0), (1, 1)), mode='edge')
+        smooth = np.minimum(amplitudes, (padded[:, :-2] + padded[:, 1:-1]
+                                         + padded[:, 2:]) / 3)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            kept = np.where(amplitudes > 0, 1 - smooth/amplitudes, 0.0)
+        lobes = (bins[:, :, np.newaxis] + self._lobe).reshape(n, -1)
+        np.clip(lobes, 0, self._n_bins - 1, out=lobes)
+        magnitude[rows, lobes] *= np.repeat(
+                kept, len(self._lobe), axis=1)
+
+
+
+### ------------------- Test that it works properly ---------------------------
+
+if __name__ == '__main__':
+    from synth import SimplePolySynth, OFFSET_TRI_01, ORGAN_ENVELOPE
+
+    # Chords played by a synth, recovered as MIDI notes, octaves included
+    chords = [(48, 52, 55), (57, 60, 64, 69), (50, 57, 65), (43, 59, 62),
+              (48, 55, 64, 72)]
+    synth = SimplePolySynth(OFFSET_TRI_01, ORGAN_ENVELOPE)
+    finder = MultiPitchFinder()
+    for chord in chords:
+        for note in chord:
+            synth.note_on(note, 100)
+        frequencies = np.concatenate([finder.analyze(synth.get_data(256))[0]
+                                      for _ in range(int(0.5*44100/256))])
+        for note in chord:
+            synth.note_off(note)
+        # Let the release end, then check the frames after the attack
+        finder.analyze(synth.get_data(int(0.3*44100)))
+        found = [set(np.rint(69 + 12*np.log2(f[np.isfinite(f)]/440)).astype(int))
+                 for f in frequencies[10:]]
+        correct = sum(notes == set(chord) for notes in found)
+        print(chord, "found in {} of {} frames".format(correct, len(found)))
+        assert correct >= 0.9 * len(found)
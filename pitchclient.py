@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Load generator for pitchserver.py.
+
+Opens many sessions at once, each streaming a sine wave of its own frequency,
+in real time or as fast as possible, and measures the end-to-end latency:
+the time from sending the last sample of a hop to receiving its estimate.
+Unless told to use a running server, it starts its own server in another
+process and measures its CPU time, to estimate how many real-time sessions
+one core can serve.
+
+Usage: python pitchclient.py --sessions 50 --duration 10
+       python pitchclient.py --external --unix /tmp/pitch.sock
+"""
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+from pitchserver import SAMPLE, ESTIMATE
+
+
+async def run_session(open_connection, frequency, duration, fs=44100,
+                      hop=256, realtime=True, packet=1):
+    """Stream a noisy sine wave to the server, and receive its estimates.
+
+    packet : number of hops of audio sent at once
+
+    Returns
+    -------
+    latencies : array of the latency of each estimate, in seconds
+    frequencies : array of the frequency of each estimate
+    """
+    reader, writer = await open_connection()
+    loop = asyncio.get_running_loop()
+    n_hops = int(duration * fs / hop) // packet * packet
+    t = np.arange(n_hops * hop) / fs
+    signal = (0.5 * np.sin(2*np.pi*frequency*t)
+              + 0.01 * np.random.randn(len(t))).astype(SAMPLE)
+    sent_at = np.full(n_hops, np.nan)
+
+    async def send():
+        start = loop.time()
+        for k in range(0, n_hops, packet):
+            if realtime:
+                await asyncio.sleep(start + (k+packet)*hop/fs - loop.time())
+            sent_at[k:k+packet] = loop.time()
+            writer.write(signal[k*hop:(k+packet)*hop].tobytes())
+            await writer.drain() # wait while the server is not reading
+        writer.write_eof()
+
+    async def receive():
+        record = 3 * ESTIMATE.itemsize
+        pending = bytearray()
+        latencies, frequencies = [], []
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            now = loop.time()
+            pending += data
+            n = len(pending) // record
+            block = pending[:n*record]
+            del pending[:n*record]
+            estimates = np.frombuffer(block, dtype=ESTIMATE).reshape(n, 3)
+            hops = np.round(estimates[:, 0] * fs / hop).astype(int) - 1
+            latencies.append(now - sent_at[hops])
+            frequencies.append(estimates[:, 1])
+        return np.concatenate(latencies), np.concatenate(frequencies)
+
+    try:
+        _, (latencies, frequencies) = await asyncio.gather(send(), receive())
+    finally:
+        writer.close()
+    return latencies, frequencies
+
+
+async def load_test(open_connection, sessions, duration, **kwargs):
+    """Run sessions at once, with frequencies between 100 and 800Hz.
+
+    kwargs are those of run_session.
+
+    Returns
+    -------
+    frequencies : array of the frequency sent by each session
+    results : list of the results of run_session for each session
+    """
+    frequencies = 100 * 2**(3 * np.random.rand(sessions))
+    results = await asyncio.gather(*[
+            run_session(open_connection, f, duration, **kwargs)
+            for f in frequencies])
+    return frequencies, results
+
+
+def process_cpu_time(pid):
+    """CPU time used by a process, in seconds, or None without /proc."""
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def start_server(args):
+    """Start pitchserver.py in another process, and wait until it listens."""
+    command = [sys.executable,
+               os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'pitchserver.py'),
+               '--fs', str(args.fs), '--hop', str(args.hop),
+               '--report', '3600']
+    command += ['--unix', args.unix] if args.unix \
+               else ['--host', args.host, '--port', str(args.port)]
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while True:
+        family = socket.AF_UNIX if args.unix else socket.AF_INET
+        with socket.socket(family) as sock:
+            try:
+                sock.connect(args.unix or (args.host, args.port))
+                return server
+            except OSError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    server.kill()
+                    raise
+                time.sleep(0.05)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Measure the latency and capacity of pitchserver.py.")
+    parser.add_argument('--sessions', type=int, default=20,
+                        help="Number of sessions at once")
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help="Seconds of audio sent by each session")
+    parser.add_argument('--fast', action='store_true',
+                        help="Send the audio as fast as possible, instead of "
+                             "in real time")
+    parser.add_argument('--packet', type=int, default=1,
+                        help="Number of hops of audio sent at once")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9998)
+    parser.add_argument('--unix', metavar='PATH',
+                        help="Connect to this Unix socket instead of TCP")
+    parser.add_argument('--external', action='store_true',
+                        help="Connect to a running server, instead of "
+                             "starting one")
+    parser.add_argument('--fs', type=int, default=44100)
+    parser.add_argument('--hop', type=int, default=256)
+    args = parser.parse_args(argv)
+
+    if args.unix:
+        open_connection = lambda: asyncio.open_unix_connection(args.unix)
+    else:
+        open_connection = lambda: asyncio.open_connection(args.host,
+                                                          args.port)
+    server = None if args.external else start_server(args)
+    try:
+        cpu = server and process_cpu_time(server.pid)
+        start = time.perf_counter()
+        frequencies, results = asyncio.run(load_test(
+                open_connection, args.sessions, args.duration, fs=args.fs,
+                hop=args.hop, realtime=not args.fast, packet=args.packet))
+        elapsed = time.perf_counter() - start
+        if cpu is not None:
+            cpu = process_cpu_time(server.pid) - cpu
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    latencies = np.concatenate([latency for latency, _ in results])
+    errors = [np.nanmedian(np.abs(1200 * np.log2(estimates[10:] / f)))
+              for f, (_, estimates) in zip(frequencies, results)]
+    audio = args.sessions * args.duration
+    print("{} sessions, {:.0f}s of audio in {:.1f}s ({:.1f}x real time)"
+          .format(args.sessions, audio, elapsed, audio / elapsed))
+    print("Latency: median {:.1f}ms, 99th percentile {:.1f}ms, max {:.1f}ms"
+          .format(*1000 * np.percentile(latencies, [50, 99, 100])))
+    print("Median error {:.1f} cents, worst session {:.1f} cents"
+          .format(np.median(errors), np.max(errors)))
+    if cpu:
+        print("Server: {:.2f}s of CPU, about {:.0f} real-time sessions per "
+              "core".format(cpu, audio / cpu))
+
+
+if __name__ == '__main__':
+    main()
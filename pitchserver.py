@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Pitch detection service for many concurrent audio streams.
+
+Clients connect over TCP or a Unix socket, and send raw mono PCM audio, as
+float32 little-endian samples at the sampling frequency of the server.
+Each connection is a session with its own PeriodFinder, so the filter and
+the zero crossings carry over from one packet to the next, whatever their
+length. After every `hop` samples, the server sends back one estimate, as
+three float64 little-endian numbers: the time of the end of the hop in
+seconds since the beginning of the stream, the frequency in Hz (nan for
+silence), and the confidence, as `pitchstream.send_pitch_udp`.
+
+The samples received at once are analyzed together with PeriodFinder.track,
+so that a busy server analyzes larger batches. When more than `max_pending`
+bytes of estimates of a session wait to be sent, because its client does
+not read them, that session stops being read until they are sent: the TCP
+buffers then slow down that client only. Sessions which send nothing for
+`idle_timeout` seconds are closed.
+
+Usage: python pitchserver.py --port 9998
+       python pitchserver.py --unix /tmp/pitch.sock
+"""
+import argparse
+import asyncio
+import socket
+import time
+
+import numpy as np
+
+from periodfinder import PeriodFinder
+
+
+SAMPLE = np.dtype('<f4') # received samples
+ESTIMATE = np.dtype('<f8') # fields of the estimates sent
+
+
+class PitchServer:
+    """Analyze the audio of each connection with its own PeriodFinder."""
+
+    def __init__(self, fs=44100, hop=256, idle_timeout=10.0, max_batch=64,
+                 max_pending=65536, **finder_kwargs):
+        """
+        Parameters
+        ----------
+        fs : sampling frequency of the audio sent by the clients
+        hop : number of samples between two estimates
+        idle_timeout : seconds without any audio after which a session is
+            closed
+        max_batch : maximal number of hops analyzed at once for a session,
+            so that other sessions are not kept waiting
+        max_pending : bytes of estimates waiting to be sent to a client,
+            above which its session is not read anymore
+        finder_kwargs : other arguments of the PeriodFinder of each session.
+            Decimation only pays off if the clients send thousands of
+            samples at once: real-time clients sending one hop at a time
+            are analyzed faster without it.
+        """
+        self.fs = fs
+        self.hop = hop
+        self.idle_timeout = idle_timeout
+        self._read_size = max_batch * hop * SAMPLE.itemsize
+        self.max_pending = max_pending
+        self._finder_kwargs = finder_kwargs
+        PeriodFinder(fs=fs, **finder_kwargs) # design the filter only once
+        self.sessions = 0 # open sessions
+        self.total_sessions = 0
+        self.evicted = 0 # sessions closed because they were idle
+        self.hops = 0 # estimates sent
+
+    async def handle(self, reader, writer):
+        """Serve one session, until the client closes it or is idle."""
+        finder = PeriodFinder(fs=self.fs, **self._finder_kwargs)
+        # Bound the buffers of the estimates, which the kernel would
+        # otherwise let grow to megabytes
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF,
+                            self.max_pending)
+        writer.transport.set_write_buffer_limits(high=self.max_pending)
+        hop_bytes = self.hop * SAMPLE.itemsize
+        pending = bytearray()
+        hops_done = 0
+        self.sessions += 1
+        self.total_sessions += 1
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(
+                            reader.read(self._read_size), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    self.evicted += 1
+                    break
+                if not data:
+                    break
+                pending += data
+                n_hops = len(pending) // hop_bytes
+                if n_hops == 0:
+                    continue
+                block = pending[:n_hops*hop_bytes]
+                del pending[:n_hops*hop_bytes]
+                samples = np.frombuffer(block, dtype=SAMPLE).astype(float)
+                estimates = np.empty((n_hops, 3), dtype=ESTIMATE)
+                estimates[:, 0] = np.arange(hops_done + 1,
+                                            hops_done + n_hops + 1)
+                estimates[:, 0] *= self.hop / self.fs
+                estimates[:, 1], estimates[:, 2] = finder.track(samples,
+                                                                self.hop)
+                hops_done += n_hops
+                self.hops += n_hops
+                writer.write(estimates.tobytes())
+                await writer.drain() # wait while the client is not reading
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions -= 1
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def report(self, interval, file=None):
+        """Print the number of sessions, estimates and CPU load regularly."""
+        last_hops, last_cpu = self.hops, time.process_time()
+        while True:
+            await asyncio.sleep(interval)
+            hops, cpu = self.hops, time.process_time()
+            print("{} sessions ({} in total, {} evicted), {:.0f} estimates/s, "
+                  "CPU {:.0%}".format(self.sessions, self.total_sessions,
+                                      self.evicted,
+                                      (hops - last_hops) / interval,
+                                      (cpu - last_cpu) / interval),
+                  file=file, flush=True)
+            last_hops, last_cpu = hops, cpu
+
+    async def serve(self, host='127.0.0.1', port=9998, path=None,
+                    report_interval=None):
+        """Serve until cancelled, on a TCP port or on a Unix socket."""
+        if path is not None:
+            server = await asyncio.start_unix_server(self.handle, path)
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+        reporter = None if report_interval is None else \
+                       asyncio.ensure_future(self.report(report_interval))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Serve pitch estimates of the audio sent by clients.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9998)
+    parser.add_argument('--unix', metavar='PATH',
+                        help="Listen on this Unix socket instead of TCP")
+    parser.add_argument('--fs', type=int, default=44100,
+                        help="Sampling frequency of the clients' audio")
+    parser.add_argument('--hop', type=int, default=256,
+                        help="Samples between two estimates")
+    parser.add_argument('--idle-timeout', type=float, default=10.0,
+                        help="Seconds after which idle sessions are closed")
+    parser.add_argument('--report', type=float, default=10.0, metavar='SECONDS',
+                        help="Interval between two lines of statistics")
+    args = parser.parse_args(argv)
+
+    server = PitchServer(args.fs, args.hop, args.idle_timeout)
+    try:
+        asyncio.run(server.serve(args.host, args.port, args.unix,
+                                 args.report))
+    except KeyboardInterrupt:
+        pass
+    print("Served {} sessions, {} estimates, {} evicted, in {:.2f}s of CPU"
+          .format(server.total_sessions, server.hops, server.evicted,
+                  time.process_time()), flush=True)
+
+
+if __name__ == '__main__':
+    main()
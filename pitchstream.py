@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""
+Stream of pitch estimates, from the audio thread to any number of consumers.
+
+The audio thread publishes timestamped estimates into a lock-free queue, and
+never waits. A dispatcher thread sends them by batches to the subscriptions,
+each with its own bounded queue: when a consumer is too slow, its oldest
+batches are dropped, without slowing down the audio or the other consumers.
+
+Usage:
+    stream = PitchStream()
+    stream.add_consumer(log_pitch, 'pitch.csv')
+    stream.add_consumer(send_pitch_udp, ('localhost', 9999), rate=50)
+    stream.start()
+    ...
+    def callback(indata, outdata, frames, time, status):
+        stream.publish(t, pf(indata[:, 0]))
+"""
+import queue
+import socket
+import threading
+
+import numpy as np
+
+from ringbuffer import MessageQueue
+
+
+class Subscription:
+    """Batches of pitch events received from a PitchStream.
+
+    The batches are arrays of shape (n, 3), whose columns are the time in
+    seconds, the frequency in Hz and the confidence, as in `pitchtrack.py`.
+    Iterating over a subscription waits for the batches, until the stream
+    is stopped.
+    """
+
+    def __init__(self, rate=None, maxsize=100):
+        """
+        rate : maximal number of events per second, or None to keep all the
+            events. Only the first event of each interval of 1/rate seconds
+            is kept.
+        maxsize : number of batches waiting, above which the oldest are
+            dropped
+        """
+        self._queue = queue.Queue(maxsize)
+        self._rate = rate
+        self._last_slot = -np.inf
+        self.dropped = 0 # events dropped because the consumer was too slow
+
+    def _put(self, batch):
+        """Called by the dispatcher thread. Never waits."""
+        if batch is not None and self._rate is not None:
+            batch = self._decimate(batch)
+            if len(batch) == 0:
+                return
+        while True:
+            try:
+                self._queue.put_nowait(batch)
+                return
+            except queue.Full:
+                try:
+                    oldest = self._queue.get_nowait()
+                    self.dropped += len(oldest) if oldest is not None else 0
+                except queue.Empty:
+                    pass
+
+    def _decimate(self, batch):
+        slots = np.floor(batch[:, 0] * self._rate)
+        keep = np.empty(len(slots), dtype=bool)
+        keep[0] = slots[0] > self._last_slot
+        np.greater(slots[1:], slots[:-1], out=keep[1:])
+        self._last_slot = slots[-1]
+        return batch[keep]
+
+    def get(self, timeout=None):
+        """Wait for the next batch.
+
+        Returns None when the stream is stopped, and raises queue.Empty
+        after `timeout` seconds without any batch.
+        """
+        return self._queue.get(timeout=timeout)
+
+    def get_all(self):
+        """All the events received since the last call, without waiting.
+
+        Returns an array of shape (n, 3), possibly empty.
+        """
+        batches = []
+        while True:
+            try:
+                batch = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if batch is not None:
+                batches.append(batch)
+        return np.concatenate(batches) if batches else np.zeros((0, 3))
+
+    def __iter__(self):
+        while True:
+            batch = self.get()
+            if batch is None:
+                return
+            yield batch
+
+
+class PitchStream:
+    """Publish pitch estimates from the audio thread to subscriptions."""
+
+    def __init__(self, capacity=4096, interval=0.01):
+        """
+        capacity : number of events waiting for the dispatcher thread,
+            above which new events are dropped
+        interval : time between two batches sent to the subscriptions,
+            in seconds
+        """
+        self._events = MessageQueue(capacity)
+        self._interval = interval
+        self._subscriptions = []
+        self._consumers = []
+        self._dispatcher = None
+        self._stopping = threading.Event()
+
+    @property
+    def dropped(self):
+        """Number of events dropped because the dispatcher was late."""
+        return self._events.dropped
+
+    def publish(self, time, frequency, confidence=1.0):
+        """Publish a pitch estimate. Called by a single thread, usually the
+        audio callback, and never waits."""
+        self._events.push((time, frequency, confidence))
+
+    def subscribe(self, rate=None, maxsize=100):
+        """New Subscription to the events published from now on.
+
+        Arguments are those of Subscription.
+        """
+        subscription = Subscription(rate, maxsize)
+        self._subscriptions = self._subscriptions + [subscription]
+        return subscription
+
+    def add_consumer(self, consumer, *args, rate=None, maxsize=100):
+        """Call consumer(subscription, *args) in a new thread.
+
+        The thread is started with the stream, or immediately if the stream
+        is already started. The consumer should return when its subscription
+        stops yielding batches.
+        """
+        thread = threading.Thread(target=consumer, daemon=True,
+                                  args=(self.subscribe(rate, maxsize),) + args)
+        self._consumers.append(thread)
+        if self._dispatcher is not None:
+            thread.start()
+
+    def start(self):
+        """Start dispatching the events, and the consumer threads."""
+        self._stopping.clear()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+        for thread in self._consumers:
+            if not thread.is_alive():
+                thread.start()
+
+    def stop(self, timeout=1.0):
+        """Dispatch the last events, end the subscriptions, and wait up to
+        `timeout` seconds for each consumer thread."""
+        if self._dispatcher is None:
+            return
+        self._stopping.set()
+        self._dispatcher.join()
+        self._dispatcher = None
+        for subscription in self._subscriptions:
+            subscription._put(None)
+        for thread in self._consumers:
+            thread.join(timeout)
+
+    def _dispatch(self):
+        while True:
+            stopping = self._stopping.wait(self._interval)
+            events = list(self._events.drain())
+            if events:
+                batch = np.array(events, dtype=float)
+                batch.flags.writeable = False # shared by the subscriptions
+                for subscription in self._subscriptions:
+                    subscription._put(batch)
+            if stopping:
+                return
+
+
+def log_pitch(subscription, filename):
+    """Consumer writing the events to a CSV file, as `pitchtrack.py`."""
+    with open(filename, 'w') as f:
+        f.write('time,frequency,confidence\n')
+        for batch in subscription:
+            np.savetxt(f, batch, fmt=('%.6f', '%.3f', '%.3f'), delimiter=',')
+            f.flush()
+
+
+def send_pitch_udp(subscription, address):
+    """Consumer sending the events as UDP datagrams, one per batch.
+
+    Each datagram holds the rows of a batch, as float64 (time, frequency,
+    confidence) triplets in little-endian order. Datagrams that cannot be
+    sent are dropped.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for batch in subscription:
+            try:
+                sock.sendto(batch.astype('<f8').tobytes(), address)
+            except OSError:
+                pass
+
+
+def receive_pitch_udp(address, timeout=None):
+    """Receive the events sent by `send_pitch_udp`, standing in for a
+    remote consumer.
+
+    Yields arrays of shape (n, 3), until no datagram is received for
+    `timeout` seconds.
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(address)
+        sock.settimeout(timeout)
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                return
+            yield np.frombuffer(data, dtype='<f8').reshape(-1, 3)
+
+
+
+### ------------------- Test that it works properly ---------------------------
+
+if __name__ == '__main__':
+    import os
+    import tempfile
+    import time
+
+    stream = PitchStream()
+    all_events = stream.subscribe()
+    decimated = stream.subscribe(rate=50)
+    slow = stream.subscribe(maxsize=2)
+
+    address = ('127.0.0.1', 9999)
+    received = []
+    receiver = threading.Thread(target=lambda: received.extend(
+            receive_pitch_udp(address, timeout=0.5)))
+    receiver.start()
+    time.sleep(0.1) # let the receiver bind its socket
+    stream.add_consumer(send_pitch_udp, address)
+    filename = os.path.join(tempfile.mkdtemp(), 'pitch.csv')
+    stream.add_consumer(log_pitch, filename)
+    stream.start()
+
+    # One estimate every 256 samples, during one second
+    hop = 256 / 44100
+    n = int(1 / hop)
+    for k in range(n):
+        stream.publish(k * hop, 440.0, 1.0)
+        time.sleep(hop / 10)
+    stream.stop()
+    receiver.join()
+
+    assert len(all_events.get_all()) == n
+    assert len(decimated.get_all()) == 50
+    assert len(slow.get_all()) + slow.dropped == n
+    assert len(np.loadtxt(filename, delimiter=',', skiprows=1)) == n
+    assert sum(len(batch) for batch in received) == n
+    print("{} events received, {} dropped by the slow consumer"
+          .format(n, slow.dropped))
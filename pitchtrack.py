@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+Offline pitch tracking of WAV files.
+
+The files are memory-mapped and analyzed by large blocks, so that even hours
+of audio never need to be loaded into memory at once.
+
+Files can also be analyzed in parallel. Long files are then split into
+chunks, each analyzed after a warm-up region of the preceding audio, so that
+the filter transients and the period averaging do not show at the boundaries.
+
+Usage: python pitchtrack.py recording.wav -o recording.csv
+       python pitchtrack.py *.wav --jobs 8
+"""
+import argparse
+import collections
+import concurrent.futures
+import itertools
+
+import numpy as np
+
+from periodfinder import PeriodFinder
+
+
+def read_wav(filename):
+    """Memory-map a WAV file.
+
+    Returns
+    -------
+    fs : sampling frequency
+    data : array of shape (frames,) or (frames, channels)
+    """
+    import scipy.io.wavfile
+    return scipy.io.wavfile.read(filename, mmap=True)
+
+
+def to_mono(block):
+    """Convert a block of WAV data to floating-point mono data in [-1, 1]."""
+    if block.dtype == np.uint8:
+        block = (block - 128.0) / 128
+    elif np.issubdtype(block.dtype, np.integer):
+        block = block / float(-np.iinfo(block.dtype).min)
+    else:
+        block = np.asarray(block, dtype=float)
+    if block.ndim > 1:
+        block = block.mean(axis=1)
+    return block
+
+
+def track_pitch(data, fs, hop=256, blocksize=65536, pf=None):
+    """Estimate the pitch after every `hop` samples of data.
+
+    data is analyzed by blocks of about `blocksize` samples.
+    Only the full slices of `hop` samples are analyzed.
+
+    Yields
+    ------
+    track : array of shape (blocksize//hop, 3)
+        Columns are the time in seconds at the end of each slice,
+        the frequency in Hz, and the confidence.
+    """
+    if pf is None:
+        pf = PeriodFinder(fs=fs)
+    blocksize = max(blocksize // hop, 1) * hop
+    end = len(data) // hop * hop
+    for start in range(0, end, blocksize):
+        block = to_mono(data[start:min(start+blocksize, end)])
+        frequencies, confidences = pf.track(block, hop)
+        times = (start + hop * np.arange(1, len(frequencies)+1)) / fs
+        yield np.column_stack((times, frequencies, confidences))
+
+
+def write_track(tracks, filename, length):
+    """Write the blocks of a pitch track to a .csv or .npy file.
+
+    tracks : iterable of arrays of shape (n, 3)
+    length : total number of rows
+
+    The .npy file is in float64: in float32, the times of files hours long
+    would only be precise to about a millisecond.
+    """
+    if filename.endswith('.npy'):
+        out = np.lib.format.open_memmap(filename, mode='w+',
+                                        dtype=np.float64, shape=(length, 3))
+        row = 0
+        for track in tracks:
+            out[row:row+len(track)] = track
+            row += len(track)
+        out.flush()
+    else:
+        with open(filename, 'w') as f:
+            f.write('time,frequency,confidence\n')
+            for track in tracks:
+                np.savetxt(f, track, fmt=('%.6f', '%.3f', '%.3f'),
+                           delimiter=',')
+
+
+def track_chunk(filename, start, stop, hop=256, blocksize=65536,
+                warmup=44100):
+    """Pitch track of the samples start:stop of a WAV file.
+
+    The PeriodFinder first analyzes up to `warmup` samples before `start`.
+    start and warmup should be multiples of hop.
+
+    Returns
+    -------
+    track : array of shape ((stop-start)//hop, 3), as in `track_pitch`
+    """
+    fs, data = read_wav(filename)
+    pf = PeriodFinder(fs=fs)
+    warmup = min(warmup, start)
+    if warmup > 0:
+        pf.analyze(to_mono(data[start-warmup:start]))
+    track = np.concatenate(list(track_pitch(data[start:stop], fs, hop,
+                                            blocksize, pf))
+                           or [np.zeros((0, 3))])
+    track[:, 0] += start / fs
+    return track
+
+
+def split_chunks(length, chunk_size, hop):
+    """Boundaries (start, stop) of the chunks of a file of `length` samples."""
+    chunk_size = max(chunk_size // hop, 1) * hop
+    end = length // hop * hop
+    return [(start, min(start + chunk_size, end))
+            for start in range(0, end, chunk_size)]
+
+
+def ordered_map(executor, fn, iterable, max_pending):
+    """Like executor.map, but with at most `max_pending` tasks submitted
+    at any time. Results are yielded in order."""
+    pending = collections.deque()
+    for args in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(fn, *args))
+    while pending:
+        yield pending.popleft().result()
+
+
+def track_file(filename, hop=256, blocksize=65536):
+    """Pitch track of a WAV file.
+
+    Returns
+    -------
+    length : number of rows of the track
+    tracks : iterator over the arrays of shape (n, 3) of the track
+    """
+    fs, data = read_wav(filename)
+    return len(data) // hop, track_pitch(data, fs, hop, blocksize)
+
+
+def track_files_parallel(filenames, jobs, hop=256, blocksize=65536,
+                         chunk_seconds=60.0, warmup_seconds=1.0):
+    """Pitch track of several WAV files, analyzed by a pool of processes.
+
+    Yields the same as `track_file` for each file, in order. Each iterator
+    should be consumed before the next one.
+    """
+    files, tasks = [], []
+    for filename in filenames:
+        fs, data = read_wav(filename)
+        warmup = int(warmup_seconds * fs) // hop * hop
+        chunks = split_chunks(len(data), int(chunk_seconds * fs), hop)
+        tasks += [(filename, start, stop, hop, blocksize, warmup)
+                  for start, stop in chunks]
+        files.append((len(data) // hop, len(chunks)))
+        del data
+
+    with concurrent.futures.ProcessPoolExecutor(jobs) as executor:
+        results = ordered_map(executor, track_chunk, tasks, 2 * jobs)
+        for length, n_chunks in files:
+            yield length, itertools.islice(results, n_chunks)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description="Estimate the pitch of WAV files.")
+    parser.add_argument('input', nargs='+', help="WAV files to analyze")
+    parser.add_argument('-o', '--output', action='append',
+                        help="Output file (.csv or .npy) for each input. "
+                             "Default is the input file with .csv extension.")
+    parser.add_argument('--hop', type=int, default=256,
+                        help="Samples between two estimates (default 256)")
+    parser.add_argument('--blocksize', type=int, default=65536,
+                        help="Samples analyzed at once (default 65536)")
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help="Number of worker processes (default 1)")
+    parser.add_argument('--chunk-seconds', type=float, default=60.0,
+                        help="With several jobs, length of the chunks "
+                             "analyzed by each process (default 60)")
+    parser.add_argument('--warmup-seconds', type=float, default=1.0,
+                        help="With several jobs, audio analyzed before each "
+                             "chunk and discarded (default 1)")
+    args = parser.parse_args(argv)
+
+    outputs = args.output or [name.rsplit('.', 1)[0] + '.csv'
+                              for name in args.input]
+    if len(outputs) != len(args.input):
+        parser.error("Give one output file per input file.")
+
+    if args.jobs > 1:
+        results = track_files_parallel(args.input, args.jobs, args.hop,
+                                       args.blocksize, args.chunk_seconds,
+                                       args.warmup_seconds)
+    else:
+        results = (track_file(name, args.hop, args.blocksize)
+                   for name in args.input)
+
+    for input_name, output_name, (length, tracks) in zip(args.input, outputs,
+                                                         results):
+        write_track(tracks, output_name, length)
+        print(input_name, '->', output_name)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,7 +5,6 @@ Created on Sun Dec 15 21:37:38 2019
 @author: User
 """
 import mido
-import sounddevice as sd
 import time
 
 from synth import *
@@ -13,61 +12,191 @@ from synth import *
 
 
 class MidiFilePlayer:
-    def __init__(self, filename, msg_handler, timer):
+    def __init__(self, filename, msg_handler, timer, lookahead=0.1,
+                 late_threshold=0.003):
         """
         filename : str
             Midi file to play
-        msg_handler : callable(MidiMessage)
-            Called to handle each MidiMessage in real time
+        msg_handler : callable(MidiMessage, float)
+            Called with each MidiMessage and the time when it should be
+            handled, up to `lookahead` seconds in advance.
         timer : callable
             Called to get the current time in seconds.
-            Should be as precise as possible.
+        lookahead : float
+            Should be longer than the interval between two calls to callback.
+        late_threshold : float
+            Messages sent more than this many seconds after their time are
+            counted as late, in `late` and `worst_lateness`. Nothing is
+            printed, since callback runs in the audio thread.
         """
         self.mid = mido.MidiFile(filename)
         self.msg_handler = msg_handler
         self.iterator = self.callback_iterator()
         self.timer = timer
+        self.lookahead = lookahead
+        self.late_threshold = late_threshold
 
         self.finished = False
+        self.late = 0 # messages sent late
+        self.worst_lateness = 0.0 # in seconds
 
     def callback_iterator(self):
+        t = self.timer()
         for msg in self.mid:
-            self.last_note_ns = self.timer()
-            while (self.timer() - self.last_note_ns) < msg.time:
+            t += msg.time
+            while t > self.timer() + self.lookahead:
                 yield
-            self.msg_handler(msg)
-
-            elapsed =  (self.timer() - self.last_note_ns)
-            err = elapsed - msg.time
-            if err > 0.003:
-                print("Oops! I'm {:.3f}s late".format(err))
+            err = self.timer() - t
+            if err > self.late_threshold:
+                self.late += 1
+                self.worst_lateness = max(self.worst_lateness, err)
+            self.msg_handler(msg, t)
 
     def callback(self):
-        """Call this often. Checks if we should send any MidiMessage now."""
+        """Call this often. Sends the MidiMessages that will happen soon."""
         try:
             next(self.iterator)
         except StopIteration:
             self.finished = True
 
 
-def play_midi_file(filename, synth):
+def play_midi_file(filename, synth, blocksize=1024, blocks_ahead=0):
+    """Play a MIDI file with a synth in real time.
+
+    blocks_ahead : if not 0, the synth renders this number of blocks ahead
+        of the audio callback, in another thread (see RenderAhead)
+    """
+    import contextlib
+    import sounddevice as sd
+    from profiling import CallbackProfiler
 
+    get_data = CallbackProfiler(synth.get_data)
+    get_data.start_reporting(interval=10.0)
+    ahead = RenderAhead(get_data, blocksize, blocks_ahead) \
+                if blocks_ahead else None
+    # The messages are handled by the synth at the exact frame where they
+    # happen, so the block size does not change the timing. They should
+    # reach the synth before it renders that frame.
     player = MidiFilePlayer(filename,
                             msg_handler=synth.receive,
-                            timer=synth.get_time)
+                            timer=synth.get_time if ahead is None
+                                  else ahead.get_time,
+                            lookahead=2*blocksize/SAMPLERATE
+                                      + (ahead.latency if ahead else 0))
 
     def callback(indata, outdata, frames, time, status):
-        outdata[:, 0] = synth.get_data(frames)
+        get_data.count_status(status)
         player.callback()
-
-    with sd.Stream(samplerate=SAMPLERATE, channels=1, callback=callback, blocksize=128):
-        while not player.finished:
-            time.sleep(1)
-
+        if ahead is None:
+            outdata[:, 0] = get_data(frames)
+        else:
+            ahead.read(outdata[:, 0])
+
+    try:
+        with ahead or contextlib.nullcontext(), \
+                sd.Stream(samplerate=SAMPLERATE, channels=1,
+                          callback=callback, blocksize=blocksize):
+            late = 0
+            while not player.finished:
+                time.sleep(1)
+                if player.late > late:
+                    print("Oops! {} messages late, up to {:.3f}s".format(
+                            player.late - late, player.worst_lateness))
+                    late = player.late
+    finally:
+        get_data.stop_reporting()
+        print("{} messages late, up to {:.3f}s".format(
+                player.late, player.worst_lateness))
+        print("Total:", get_data.format_stats())
+        if ahead is not None:
+            print(ahead.format_stats())
+
+
+
+def render_midi_file(filename, synth, output, blocksize=8192, tail=1.0):
+    """Render a MIDI file with a synth to a WAV file, as fast as possible.
+
+    Each message is sent to the synth at the exact sample where it should
+    happen, and the audio is written to `output` block by block.
+
+    filename : str
+        Midi file to render
+    synth : Synth
+        Synth that receives the MidiMessages
+    output : str
+        WAV file to write, 16 bits
+    blocksize : int
+        Maximal number of frames rendered at once
+    tail : float
+        Seconds rendered after the last message, for the release of the notes
+
+    Returns the duration of the rendered audio, in seconds.
+
+    Raises RuntimeError, once the file is written, if the synth dropped
+    some messages.
+    """
+    import wave
+
+    with wave.open(output, 'wb') as out:
+        out.setsampwidth(2)
+        out.setframerate(SAMPLERATE)
+        data = synth.get_data(0)
+        out.setnchannels(1 if data.ndim == 1 else data.shape[1])
+        rendered = 0
+        dropped = 0
+
+        def render_until(end):
+            nonlocal rendered
+            while rendered < end:
+                frames = min(blocksize, end - rendered)
+                data = np.clip(synth.get_data(frames), -1, 1)
+                out.writeframes((data * 32767).astype('<i2').tobytes())
+                rendered += frames
+
+        t = 0.0
+        for msg in mido.MidiFile(filename):
+            t += msg.time
+            if not msg.is_meta:
+                render_until(round(t * SAMPLERATE))
+                if not synth.receive(msg):
+                    # Too many messages at once for the queue of the synth:
+                    # rendering no frames empties it, without handling them
+                    synth.get_data(0)
+                    if not synth.receive(msg):
+                        dropped += 1
+        render_until(round((t + tail) * SAMPLERATE))
+    if dropped:
+        raise RuntimeError("{} MIDI messages were dropped by the synth"
+                           .format(dropped))
+    return rendered / SAMPLERATE
 
 
 if __name__ == '__main__':
-    filename = 'Dejected_Groose_piano.mid'
-    print("Playing", filename, "with ORGAN_SYNTH")
-    play_midi_file(filename, SIMPLE_FM_SYNTH)
-
+    import argparse
+    parser = argparse.ArgumentParser(
+            description="Play a MIDI file, or render it to a WAV file.")
+    parser.add_argument('filename', nargs='?', default='Dejected_Groose_piano.mid')
+    parser.add_argument('--synth', default='SIMPLE_FM_SYNTH',
+                        help="Name of a synth of synth.py (default SIMPLE_FM_SYNTH)")
+    parser.add_argument('-o', '--output',
+                        help="Render to this WAV file as fast as possible, "
+                             "instead of playing in real time")
+    parser.add_argument('--blocksize', type=int, default=8192,
+                        help="Frames rendered at once to the WAV file")
+    parser.add_argument('--ahead', type=int, default=0, metavar='BLOCKS',
+                        help="When playing, render this number of blocks "
+                             "ahead of the audio callback, in another "
+                             "thread (default 0, render in the callback)")
+    args = parser.parse_args()
+    synth = globals()[args.synth]
+
+    if args.output:
+        start = time.perf_counter()
+        duration = render_midi_file(args.filename, synth, args.output,
+                                    args.blocksize)
+        elapsed = time.perf_counter() - start
+        print("Rendered {:.1f}s of audio to {} in {:.1f}s ({:.1f}x real time)"
+              .format(duration, args.output, elapsed, duration/elapsed))
+    else:
+        print("Playing", args.filename, "with", args.synth)
+        play_midi_file(args.filename, synth, blocks_ahead=args.ahead)
@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+Profiling of the functions called in an audio callback.
+
+CallbackProfiler wraps a function such as `Synth.get_data` or a
+`PeriodFinder`, and records how long each call takes compared to its
+deadline, which is the duration of the block of audio it processes.
+The audio thread only updates counters, and the statistics are printed
+by another thread.
+
+Usage:
+    get_data = CallbackProfiler(synth.get_data)
+    get_data.start_reporting(interval=5.0)
+    ...
+    def callback(indata, outdata, frames, time, status):
+        get_data.count_status(status)
+        outdata[:, 0] = get_data(frames)
+"""
+import sys
+import threading
+import time
+
+import numpy as np
+
+
+class CallbackProfiler:
+    """Wrap a function called once per block of audio, and profile it.
+
+    The first argument of the function should be the number of frames of
+    the block, or an array of data with one element per frame.
+
+    The wall-clock time of each call is recorded in a histogram of the
+    load, that is the fraction of the deadline it used. A call overruns
+    when it takes longer than its deadline.
+    """
+
+    def __init__(self, func, fs=44100, name=None, max_load=2.0, n_bins=100):
+        """
+        Parameters
+        ----------
+        func : function to profile
+        fs : sampling frequency, used to compute the deadline of each block
+        name : name shown in the statistics, by default the name of func
+        max_load : loads above this are counted together in the last bin
+        n_bins : number of bins of the histogram up to max_load
+        """
+        self._func = func
+        self.fs = fs
+        self.name = name or getattr(func, '__qualname__', type(func).__name__)
+        self.bin_width = max_load / n_bins
+        self.counts = np.zeros(n_bins + 1, dtype=int)
+        self.calls = 0
+        self.overruns = 0
+        self.xruns = 0
+        self.busy_time = 0.0 # seconds spent in func
+        self.budget_time = 0.0 # sum of the deadlines
+        self.worst_load = 0.0
+        self._reporter = None
+        self._stop_reporting = threading.Event()
+
+    def __call__(self, data, *args, **kwargs):
+        start = time.perf_counter()
+        result = self._func(data, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        frames = data if isinstance(data, (int, np.integer)) else len(data)
+        budget = frames / self.fs
+        load = elapsed / budget if budget > 0 else 0.0
+        self.counts[min(int(load / self.bin_width), len(self.counts) - 1)] += 1
+        self.calls += 1
+        self.busy_time += elapsed
+        self.budget_time += budget
+        if load > 1.0:
+            self.overruns += 1
+        if load > self.worst_load:
+            self.worst_load = load
+        return result
+
+    def count_status(self, status):
+        """Count an xrun if the status flags of the audio callback show an
+        input overflow or output underflow."""
+        if status:
+            self.xruns += 1
+
+    def snapshot(self):
+        """Copy of the counters, to compute the statistics of an interval."""
+        return dict(counts=self.counts.copy(), calls=self.calls,
+                    overruns=self.overruns, xruns=self.xruns,
+                    busy_time=self.busy_time, budget_time=self.budget_time)
+
+    def stats(self, since=None):
+        """Statistics of the calls since a snapshot, or since the beginning.
+
+        Returns
+        -------
+        stats : dict with the number of calls, overruns and xruns, the
+            average load, the 50th and 99th percentiles of the load
+            (upper edges of their histogram bins), and the worst load
+            since the beginning
+        """
+        now = self.snapshot()
+        if since is not None:
+            now = {key: value - since[key] for key, value in now.items()}
+        counts = now['counts']
+        total = counts.sum()
+        def percentile(q):
+            if total == 0:
+                return 0.0
+            index = np.searchsorted(np.cumsum(counts), q * total)
+            return (index + 1) * self.bin_width if index < len(counts) - 1 \
+                else np.inf
+        budget = now['budget_time']
+        return dict(name=self.name, calls=now['calls'],
+                    overruns=now['overruns'], xruns=now['xruns'],
+                    load=now['busy_time'] / budget if budget else 0.0,
+                    p50=percentile(0.5), p99=percentile(0.99),
+                    worst=self.worst_load)
+
+    def format_stats(self, since=None):
+        """The statistics of `stats`, on one line."""
+        return ("{name}: {calls} calls, load {load:.0%}, p50 {p50:.0%}, "
+                "p99 {p99:.0%}, worst {worst:.0%} of deadline, "
+                "{overruns} overruns, {xruns} xruns"
+                .format(**self.stats(since)))
+
+    def start_reporting(self, interval=1.0, file=None):
+        """Write the statistics of every `interval` seconds to a file.
+
+        The statistics are written from a background thread, one line per
+        interval, until stop_reporting is called.
+
+        file : file object or filename, by default sys.stdout
+        """
+        self.stop_reporting()
+        self._stop_reporting.clear()
+
+        def report():
+            out = open(file, 'a') if isinstance(file, str) else file
+            try:
+                last = self.snapshot()
+                while not self._stop_reporting.wait(interval):
+                    print(self.format_stats(last), file=out or sys.stdout,
+                          flush=True)
+                    last = self.snapshot()
+            finally:
+                if out is not file:
+                    out.close()
+
+        self._reporter = threading.Thread(target=report, daemon=True)
+        self._reporter.start()
+
+    def stop_reporting(self):
+        """Stop the background thread started by start_reporting."""
+        if self._reporter is not None:
+            self._stop_reporting.set()
+            self._reporter.join()
+            self._reporter = None
+
+
+
+### ------------------- Test that it works properly ---------------------------
+
+if __name__ == '__main__':
+    # Profile a function taking 10% or 150% of the deadline of its blocks
+    def work(frames):
+        time.sleep(frames / 44100 * (1.5 if work.slow else 0.1))
+    work.slow = False
+
+    profiled = CallbackProfiler(work)
+    profiled.start_reporting(interval=0.2)
+    for k in range(100):
+        work.slow = k % 10 == 0
+        profiled(256)
+    profiled.stop_reporting()
+    print("Total:", profiled.format_stats())
+    assert profiled.calls == 100 and profiled.overruns >= 10
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded queues to pass data to and from the audio thread without locks.
+
+Each queue has a single producer thread and a single consumer thread.
+The producer only writes the write counter and the consumer only writes the
+read counter, and both are plain Python integers, so neither thread ever
+waits for the other.
+"""
+import numpy as np
+
+
+class MessageQueue:
+    """Bounded single-producer, single-consumer queue of Python objects.
+
+    When the queue is full, push does not wait: the item is dropped, and
+    counted in `dropped`.
+    """
+
+    def __init__(self, capacity=1024):
+        self._slots = [None] * capacity
+        self._capacity = capacity
+        self._written = 0 # items pushed, only changed by the producer
+        self._read = 0 # items popped, only changed by the consumer
+        self.dropped = 0
+
+    def __len__(self):
+        return self._written - self._read
+
+    def push(self, item):
+        """Add an item at the end of the queue.
+
+        Returns False, and drops the item, if the queue is full.
+        """
+        written = self._written
+        if written - self._read >= self._capacity:
+            self.dropped += 1
+            return False
+        self._slots[written % self._capacity] = item
+        self._written = written + 1 # publish the item only once it is stored
+        return True
+
+    def pop(self, default=None):
+        """Remove and return the first item, or `default` if it is empty."""
+        read = self._read
+        if read == self._written:
+            return default
+        index = read % self._capacity
+        item, self._slots[index] = self._slots[index], None
+        self._read = read + 1
+        return item
+
+    def drain(self):
+        """Iterate over the items pushed up to now, removing them."""
+        for _ in range(self._written - self._read):
+            yield self.pop()
+
+
+class SampleRing:
+    """Bounded single-producer, single-consumer ring of audio frames.
+
+    Blocks of any length are copied into and out of a preallocated array,
+    so that neither thread allocates memory.
+    """
+
+    def __init__(self, capacity, channels=None):
+        """
+        capacity : maximal number of frames in the ring
+        channels : number of channels, or None for frames of one sample
+        """
+        shape = (capacity,) if channels is None else (capacity, channels)
+        self._samples = np.zeros(shape)
+        self.capacity = capacity
+        self._written = 0 # frames written, only changed by the producer
+        self._read = 0 # frames read, only changed by the consumer
+
+    def __len__(self):
+        return self._written - self._read
+
+    def space(self):
+        """Number of frames that can be written."""
+        return self.capacity - (self._written - self._read)
+
+    def write(self, data):
+        """Copy all the frames of data at the end of the ring.
+
+        Returns False, and writes nothing, if there is not enough space.
+        """
+        frames, written = len(data), self._written
+        if frames > self.capacity - (written - self._read):
+            return False
+        start = written % self.capacity
+        first = min(frames, self.capacity - start)
+        self._samples[start:start+first] = data[:first]
+        self._samples[:frames-first] = data[first:]
+        self._written = written + frames # publish once they are copied
+        return True
+
+    def read(self, out):
+        """Copy the first frames of the ring to out, and remove them.
+
+        Returns the number of frames copied, less than len(out) if the ring
+        does not hold enough frames. The rest of out is left unchanged.
+        """
+        read = self._read
+        frames = min(len(out), self._written - read)
+        start = read % self.capacity
+        first = min(frames, self.capacity - start)
+        out[:first] = self._samples[start:start+first]
+        out[first:frames] = self._samples[:frames-first]
+        self._read = read + frames
+        return frames
+
+
+
+### ------------------- Test that it works properly ---------------------------
+
+if __name__ == '__main__':
+    import threading
+    import time
+
+    # One thread pushes numbers while the other pops them
+    queue = MessageQueue(capacity=64)
+    n = 10000
+    def produce():
+        for i in range(n):
+            while not queue.push(i):
+                time.sleep(0)
+    producer = threading.Thread(target=produce)
+    producer.start()
+    received = []
+    while len(received) < n:
+        received.extend(queue.drain())
+        time.sleep(0)
+    producer.join()
+    assert received == list(range(n))
+    print("{} items received in order, {} pushes retried when full"
+          .format(n, queue.dropped))
+
+    # The same with blocks of audio frames of various lengths
+    ring = SampleRing(1000, channels=2)
+    data = np.random.randn(100000, 2)
+    def produce():
+        k = 0
+        while k < len(data):
+            block = data[k:k+np.random.randint(1, 300)]
+            if ring.write(block):
+                k += len(block)
+            else:
+                time.sleep(0)
+    producer = threading.Thread(target=produce)
+    producer.start()
+    out, k = np.empty_like(data), 0
+    while k < len(data):
+        k += ring.read(out[k:k+np.random.randint(1, 300)])
+        time.sleep(0)
+    producer.join()
+    assert np.array_equal(out, data)
+    print("{} frames received in order".format(len(data)))
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Synth rendering its voices in several processes, to use several cores.
+
+A ShardedSynth sends each note to one of its worker processes, each with
+its own synth, so that the voices are rendered in parallel despite the GIL.
+Each worker renders its blocks into its own row of an array in shared
+memory, and the parent process sums the rows where they are, without
+copying them.
+
+For each block, the parent sends one small message through a pipe to each
+worker, with the number of frames and the MIDI messages of that worker,
+and waits for one empty message back.
+
+Usage:
+    def create_synth():
+        return SimplePolySynth(OFFSET_TRI_01, ORGAN_ENVELOPE)
+
+    with ShardedSynth(create_synth, workers=4) as synth:
+        inport.callback = synth.receive
+        ...
+        outdata[:, 0] = synth.get_data(frames)
+"""
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ringbuffer import MessageQueue
+from synth import Synth, SAMPLERATE
+
+
+def _work(create_synth, conn, name, shape, index):
+    """Main function of a worker process."""
+    memory = shared_memory.SharedMemory(name=name)
+    try:
+        out = np.ndarray(shape, buffer=memory.buf)[index]
+        synth = create_synth()
+        conn.send_bytes(b'') # ready
+        while True:
+            request = conn.recv()
+            if request is None:
+                break
+            frames, messages = request
+            for time, msg in messages:
+                synth.receive(msg, time)
+            out[:frames] = synth.get_data(frames)
+            conn.send_bytes(b'')
+        del out # release the shared memory before closing it
+    finally:
+        memory.close()
+
+
+class ShardedSynth(Synth):
+    """Synth splitting its notes between the synths of worker processes.
+
+    Each note_on goes to the worker holding the fewest notes, and its
+    note_off to the same worker. The other messages, such as control
+    changes, go to all the workers.
+
+    receive can be called from one other thread, as for MidiSynth. Call
+    close, or use the synth as a context manager, to stop the workers.
+    """
+
+    def __init__(self, create_synth, workers=2, max_blocksize=8192,
+                 channels=None, queue_size=1024):
+        """
+        Parameters
+        ----------
+        create_synth : function without arguments returning a MidiSynth.
+            It is called in each worker process, so it must be picklable,
+            such as a function of a module, unless the processes are forked.
+        workers : number of worker processes
+        max_blocksize : maximal number of frames rendered at once. Longer
+            blocks are rendered in several parts.
+        channels : number of channels of the synth, or None for 1-D data
+        queue_size : number of messages waiting, above which they are dropped
+        """
+        shape = (workers, max_blocksize)
+        if channels is not None:
+            shape += (channels,)
+        self._memory = shared_memory.SharedMemory(
+                create=True, size=int(np.prod(shape)) * 8)
+        self._blocks = np.ndarray(shape, buffer=self._memory.buf)
+        self.max_blocksize = max_blocksize
+
+        self._received = MessageQueue(queue_size) # (time, msg)
+        self._held = [0] * workers # notes held by each worker
+        self._worker_of_note = {}
+        self._frames_sent = 0
+
+        self._connections = []
+        self._processes = []
+        for index in range(workers):
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                    target=_work, daemon=True,
+                    args=(create_synth, child_conn, self._memory.name, shape,
+                          index))
+            process.start()
+            self._connections.append(conn)
+            self._processes.append(process)
+        for conn in self._connections:
+            conn.recv_bytes()
+
+    def receive(self, msg, time=None):
+        """Receive a MidiMessage, as MidiSynth.receive."""
+        return self._received.push((time, msg))
+
+    def get_time(self):
+        """Time of the first frame of the next block of data."""
+        return self._frames_sent / SAMPLERATE
+
+    def _workers_of(self, msg):
+        """Indices of the workers which should receive a message."""
+        if msg.type == 'note_on' and msg.velocity > 0:
+            worker = self._worker_of_note.get(msg.note)
+            if worker is None:
+                worker = self._held.index(min(self._held))
+                self._worker_of_note[msg.note] = worker
+                self._held[worker] += 1
+            return (worker,)
+        if msg.type in ('note_on', 'note_off'):
+            worker = self._worker_of_note.pop(msg.note, None)
+            if worker is None:
+                return ()
+            self._held[worker] -= 1
+            return (worker,)
+        return range(len(self._connections))
+
+    def get_data(self, frames):
+        if frames > self.max_blocksize:
+            return np.concatenate([
+                    self.get_data(min(self.max_blocksize, frames - start))
+                    for start in range(0, frames, self.max_blocksize)])
+        messages = [[] for _ in self._connections]
+        for time, msg in self._received.drain():
+            for worker in self._workers_of(msg):
+                messages[worker].append((time, msg))
+        for conn, worker_messages in zip(self._connections, messages):
+            conn.send((frames, worker_messages))
+        for conn in self._connections:
+            conn.recv_bytes()
+        self._frames_sent += frames
+        return self._blocks[:, :frames].sum(axis=0)
+
+    def close(self):
+        """Stop the worker processes, and free the shared memory."""
+        for conn, process in zip(self._connections, self._processes):
+            conn.send(None)
+            process.join()
+        self._connections, self._processes = [], []
+        del self._blocks
+        self._memory.close()
+        self._memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+
+### ------------------- Test that it works properly ---------------------------
+
+if __name__ == '__main__':
+    import functools
+    import mido
+    from synth import SimplePolySynth, OFFSET_TRI_01, ORGAN_ENVELOPE
+
+    create_synth = functools.partial(SimplePolySynth, OFFSET_TRI_01,
+                                     ORGAN_ENVELOPE, max_polyphony=20)
+    # The same notes on one synth and on 3 workers sum to the same data
+    reference = create_synth()
+    with ShardedSynth(create_synth, workers=3, max_blocksize=256) as sharded:
+        datas, references = [], []
+        for k in range(200):
+            if k % 10 == 0:
+                messages = [mido.Message('note_on', note=60 + k//10,
+                                         velocity=100),
+                            mido.Message('note_off', note=50 + k//10)]
+                for msg in messages:
+                    sharded.receive(msg, time=sharded.get_time() + 1e-3)
+                    reference.receive(msg, time=reference.get_time() + 1e-3)
+            frames = 300 if k == 100 else 256
+            datas.append(sharded.get_data(frames))
+            references.append(reference.get_data(frames))
+        assert sum(sharded._held) == 10
+    assert np.allclose(np.concatenate(datas), np.concatenate(references))
+    print("3 workers rendered the same data as one synth")
@@ -4,26 +4,56 @@
 Created on Mon Nov 18 17:06:37 2019
 
 @author: alexis
+
+Usage: python sounddevice_test.py [--log pitch.csv] [--udp localhost:9999]
 """
+import argparse
+
 import numpy as np
 import matplotlib.pyplot as plt
 import sounddevice as sd
 from periodfinder import PeriodFinder
 from gui import PitchGUI
+from pitchstream import PitchStream, log_pitch, send_pitch_udp
+from profiling import CallbackProfiler
 
 #duration = 5.5  # seconds
+BLOCKSIZE = 64
+SAMPLERATE = 44100
+
+parser = argparse.ArgumentParser(description="Display the pitch being sung.")
+parser.add_argument('--log', help="Also write the pitch to this CSV file")
+parser.add_argument('--udp', metavar='HOST:PORT',
+                    help="Also send the pitch to this address, with UDP")
+args = parser.parse_args()
+
+stream = PitchStream()
+if args.log:
+    stream.add_consumer(log_pitch, args.log)
+if args.udp:
+    host, port = args.udp.rsplit(':', 1)
+    stream.add_consumer(send_pitch_udp, (host, int(port)))
+stream.start()
 
-pf = PeriodFinder()
-gui = PitchGUI()
+# No decimation: with such small blocks, it would cost more than it saves
+finder = PeriodFinder(fs=SAMPLERATE)
+pf = CallbackProfiler(finder, fs=SAMPLERATE)
+pf.start_reporting(interval=10.0)
+gui = PitchGUI(stream)
+mono = np.empty(BLOCKSIZE)
+frames_seen = 0
 
 def callback(indata, outdata, frames, time, status):
-    if status:
-        print(repr(status))
-    mono = np.sum(indata, axis=1)
-    f = pf(mono)
-    gui.give_frequency(f)
+    global frames_seen
+    pf.count_status(status)
+    np.sum(indata, axis=1, out=mono[:frames])
+    f = pf(mono[:frames])
+    frames_seen += frames
+    stream.publish(frames_seen / SAMPLERATE, f, finder.confidence)
     # print(f)
 
-with sd.Stream(channels=2, callback=callback, blocksize=256):
+with sd.Stream(samplerate=SAMPLERATE, channels=2, callback=callback,
+               blocksize=BLOCKSIZE):
     while plt.fignum_exists(gui.fig.number):
         plt.pause(0.5)
+stream.stop()
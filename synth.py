@@ -5,25 +5,126 @@ Created on Sun Dec 15 16:45:23 2019
 @author: User
 """
 import collections
-import threading
+import heapq
 import abc
+import threading
 
 import numpy as np
 
+from ringbuffer import MessageQueue, SampleRing
+
 SAMPLERATE = 44100
 
 class NoteFinished(Exception):
     """Exception raised when a Note cannot send any more data."""
     pass
 
-Envelope = collections.namedtuple('Envelope', ['a', 'd', 's', 'r'])
+Envelope = collections.namedtuple('Envelope', ['a', 'd', 's', 'r', 'curve'],
+                                  defaults=['linear'])
+Envelope.__doc__ = """Attack/decay/sustain/release envelope.
+
+a, d, r : durations of the attack, decay and release, in seconds
+s : sustain level
+curve : 'linear', or 'exponential' for exponential decay and release,
+    reaching -60dB of their amplitude at their end
+"""
+
+_LN_1000 = np.log(1000)
+
+def envelope_levels(envelope, t, held, release_level):
+    """Closed-form value of an envelope.
+
+    t : time since note_on, or since note_off for released notes
+    held : whether the note is still held
+    release_level : level of the envelope at note_off
+    All the arguments broadcast together.
+    """
+    a, d, s, r, curve = envelope
+    if curve == 'exponential':
+        decay = s + (1-s) * np.exp(-(t-a) * _LN_1000/d)
+        release = release_level * np.exp(-t * _LN_1000/r)
+    else:
+        decay = 1 + (t-a) * (s-1)/d
+        release = (1 - t/r) * release_level
+    attack_decay = np.where(t < a, t/a, np.where(t < a + d, decay, s))
+    return np.where(held, attack_decay, np.where(t < r, release, 0.0))
+
+def envelope_segments(envelope, t, held, release_level, frames):
+    """Describe the next `frames` frames of an envelope as simple segments.
+
+    Takes the same arguments as `envelope_levels`, for the first frame.
+    When the envelope stays in the same segment (attack, decay, sustain or
+    release) during the whole block, its value at frame n is
+        constant + slope*n + expo*rate**n
+
+    Returns
+    -------
+    constant, slope, expo, rate : coefficients of the segments
+    crossing : whether the envelope changes segment during the block,
+        in which case it should be computed with `envelope_levels`
+    finished : whether the envelope is finished (it is then zero)
+    """
+    a, d, s, r, curve = envelope
+    dt = 1/SAMPLERATE
+    last_t = t + (frames-1) * dt
+    attack = held & (last_t < a)
+    decay = held & (t >= a) & (last_t < a + d)
+    sustain = held & (t >= a + d)
+    released = np.logical_not(held) # also for a bool, where ~ gives an int
+    release = released & (last_t < r)
+    finished = released & (t >= r)
+    crossing = ~(attack | decay | sustain | release | finished)
+
+    constant = np.where(attack, t/a, 0.0) + np.where(sustain, s, 0.0)
+    slope = np.where(attack, dt/a, 0.0)
+    if curve == 'exponential':
+        constant = constant + np.where(decay, s, 0.0)
+        expo = np.where(decay, (1-s) * np.exp(-(t-a) * _LN_1000/d), 0.0) \
+               + np.where(release, release_level * np.exp(-t * _LN_1000/r), 0.0)
+        rate = np.where(decay, np.exp(-dt * _LN_1000/d),
+                        np.exp(-dt * _LN_1000/r))
+    else:
+        constant = constant \
+                   + np.where(decay, 1 + (t-a) * (s-1)/d, 0.0) \
+                   + np.where(release, (1 - t/r) * release_level, 0.0)
+        slope = slope + np.where(decay, dt * (s-1)/d, 0.0) \
+                      + np.where(release, -dt * release_level/r, 0.0)
+        expo = np.zeros_like(constant)
+        rate = np.ones_like(constant)
+    return constant, slope, expo, rate, crossing, finished
+
+def envelope_gains(envelope, t, held, release_level, frames):
+    """The next `frames` frames of an envelope, for several notes at once.
+
+    Takes the same arguments as `envelope_segments`, as arrays with one
+    element per note.
+
+    Returns
+    -------
+    gains : array of shape (notes, frames)
+    finished : whether the envelope of each note is finished
+    """
+    constant, slope, expo, rate, crossing, finished = envelope_segments(
+            envelope, t, held, release_level, frames)
+    n = np.arange(frames)
+    gains = constant[:, np.newaxis] + slope[:, np.newaxis] * n
+    if expo.any():
+        gains += expo[:, np.newaxis] * rate[:, np.newaxis]**n
+    if crossing.any():
+        gains[crossing] = envelope_levels(
+                envelope, t[crossing, np.newaxis] + n/SAMPLERATE,
+                held[crossing, np.newaxis],
+                release_level[crossing, np.newaxis])
+    return gains, finished
+
 
 class EnvelopeGain:
     def __init__(self, envelope):
-        self._env = envelope
-        self.attack, self.decay, self.sustain, self.release = self._env
+        self._env = Envelope(*envelope)
+        self.attack, self.decay, self.sustain, self.release, _ = self._env
         self._cur_level = 0.0
         self._released = False
+        self._release_volume = 0.0
         self._t = 0
 
         self.is_alive = True
@@ -31,31 +132,32 @@ class EnvelopeGain:
     def get_gain(self, frames):
         """Get the next `frames` frames of the gain.
 
+        Within a segment of the envelope, the gain is computed as a ramp,
+        a constant or an exponential, without evaluating the whole envelope.
+
         frames : int.
         returns : an array of length `frames`
         raises : NoteFinished
         """
-        tt = np.arange(frames)/SAMPLERATE + self._t
-        next_t = frames/SAMPLERATE + self._t
-        if not self._released and self._t < self.attack + self.decay:
-            atk_mask = (tt < self.attack)
-            decay_mask = ~atk_mask & (tt < self.attack + self.decay)
-            sustain_mask = ~atk_mask & ~decay_mask
-            atk = tt / self.attack
-            decay = 1 + (tt - self.attack) * (self.sustain-1) / self.decay
-            sustain = self.sustain
-            result = atk_mask*atk + decay_mask*decay + sustain_mask*sustain
-        elif not self._released:
-            result = self.sustain * np.ones(frames)
-        elif self._t < self.release:
-            release_mask = tt < self.release
-            release = (1 - tt/self.release)*self._release_volume
-            result = release_mask*release
-        else:
+        constant, slope, expo, rate, crossing, finished = envelope_segments(
+                self._env, self._t, not self._released, self._release_volume,
+                frames)
+        if finished:
             self.is_alive = False
-            result = np.zeros(frames)
-        self._cur_level = result[-1]
-        self._t = next_t
+        if crossing:
+            tt = np.arange(frames)/SAMPLERATE + self._t
+            result = envelope_levels(self._env, tt, not self._released,
+                                     self._release_volume)
+        elif slope == 0 and expo == 0:
+            result = np.full(frames, float(constant))
+        else:
+            n = np.arange(frames)
+            result = constant + slope * n
+            if expo != 0:
+                result += expo * rate**n
+        if frames:
+            self._cur_level = result[-1]
+        self._t += frames/SAMPLERATE
         return result
 
 
@@ -85,6 +187,69 @@ def freq_of_note(note):
     return 440 * 2**((note-69)/12)
 
 
+class Wavetable:
+    """A waveform sampled once into band-limited tables, one per octave.
+
+    Calling it on normalized phases interpolates in the table where the
+    harmonics above the Nyquist frequency of the given frequency are removed,
+    so that it costs the same for any waveform, and does not alias.
+    Use `get_wavetable(waveform)` to share the tables of a waveform.
+    """
+
+    def __init__(self, waveform, size=2048):
+        self.size = size
+        spectrum = np.fft.rfft(waveform(np.arange(size)/size))
+        n_octaves = int(np.log2(size)) # up to a single harmonic
+        tables = np.empty((n_octaves, size + 2))
+        for octave in range(n_octaves):
+            # Table `octave` is used up to a frequency of
+            # SAMPLERATE/size * 2**octave, so the harmonics above
+            # size/2**(octave+1) would be above the Nyquist frequency.
+            band_limited = spectrum.copy()
+            band_limited[size//2**(octave+1) + 1:] = 0
+            tables[octave, :size] = np.fft.irfft(band_limited, size)
+        tables[:, size:] = tables[:, :2]
+        # Value and slope at each sample, up to x == 1.0 included
+        self.tables = tables[:, :-1].copy()
+        self.slopes = np.diff(tables, axis=1)
+
+    def __call__(self, x, frequency=None):
+        """Evaluate the waveform.
+
+        x : array of normalized phases in [0, 1]
+        frequency : frequency of the waveform in Hz, or array of frequencies
+            with one element per row of x. None for no band limitation.
+        """
+        if frequency is None:
+            offset = 0
+        else:
+            octave = np.log2(np.maximum(np.asarray(frequency, dtype=float)
+                                        * self.size / SAMPLERATE, 1))
+            octave = np.minimum(np.ceil(octave), len(self.tables) - 1)
+            offset = octave.astype(int) * self.tables.shape[1]
+            if np.ndim(offset):
+                offset = offset[:, np.newaxis]
+        # Linear interpolation, with as few temporary arrays as possible
+        position = np.multiply(x, self.size)
+        index = position.astype(int)
+        position -= index
+        index += offset
+        data = self.slopes.ravel().take(index)
+        data *= position
+        data += self.tables.ravel().take(index)
+        return data
+
+
+_wavetables = {}
+
+def get_wavetable(waveform):
+    """The Wavetable of a waveform, computed once per waveform."""
+    try:
+        return _wavetables[waveform]
+    except KeyError:
+        return _wavetables.setdefault(waveform, Wavetable(waveform))
+
+
 class Synth(abc.ABC):
     @abc.abstractmethod
     def get_data(self, frames):
@@ -140,28 +305,43 @@ class OneNoteSynth(Synth):
     def note_off(self):
         self._envelope.note_off()
 
-class PolyphonicSynth(Synth, metaclass=abc.ABCMeta):
+class MidiSynth(Synth):
+    """Synth playing the notes of the MIDI messages it receives.
 
-    @abc.abstractmethod
-    def create_note(self, note_number, velocity):
-        pass
+    Messages are queued by receive, and handled by get_data at the exact
+    frame where they should happen, splitting the rendering of the block
+    there. Subclasses implement _render.
 
-    def __init__(self, max_polyphony=10, gain=0.1):
-        self.note_synths = collections.OrderedDict()
-        self.note_synths_dying = []
+    receive can be called from one other thread, such as the MIDI input
+    thread: the messages go through a MessageQueue, so that the audio thread
+    never waits for a lock, and all the notes are only changed by the audio
+    thread. note_on and note_off should not be called from another thread.
+    """
+
+    def __init__(self, max_polyphony=10, gain=0.1, queue_size=1024):
         self.max_polyphony = max_polyphony
         self.gain = gain
-        self._lock = threading.Lock()
 
-        self._t = 0.0
+        self._frames_sent = 0
+        self._received = MessageQueue(queue_size) # (time, msg)
+        self._scheduled = [] # heap of (frame, order, msg), for get_data only
+        self._messages_received = 0
 
-    def all_note_synths(self):
-        with self._lock:
-            yield from iter(self.note_synths.values())
-            yield from iter(self.note_synths_dying)
+    def receive(self, msg, time=None):
+        """Receive a MidiMessage.
+
+        time : float or None
+            Time when the message should be handled, in the same units as
+            get_time(). If None, it is handled at the beginning of the next
+            block of data.
+
+        Returns False if the message was dropped because too many messages
+        are waiting.
+        """
+        return self._received.push((time, msg))
 
-    def receive(self, msg):
-        print(msg)
+    def handle(self, msg):
+        """Handle a MidiMessage immediately."""
         if msg.type == 'note_on' and msg.velocity > 0:
             self.note_on(msg.note, msg.velocity)
         elif msg.type == 'note_on' and msg.velocity == 0 \
@@ -172,10 +352,61 @@ class PolyphonicSynth(Synth, metaclass=abc.ABCMeta):
     def get_time(self):
         """Get current time according to the number of samples sent.
 
-        Precision is of the order of the audio block size,
-        so frames/SAMPLERATE.
+        This is the time of the first frame of the next block of data.
         """
-        return self._t
+        return self._frames_sent / SAMPLERATE
+
+    def get_data(self, frames):
+        for when, msg in self._received.drain():
+            frame = self._frames_sent if when is None \
+                        else round(when * SAMPLERATE)
+            heapq.heappush(self._scheduled,
+                           (frame, self._messages_received, msg))
+            self._messages_received += 1
+
+        end = self._frames_sent + frames
+        datas = []
+        while self._scheduled and self._scheduled[0][0] < end:
+            frame, _, msg = heapq.heappop(self._scheduled)
+            if frame > self._frames_sent:
+                datas.append(self._render(frame - self._frames_sent))
+                self._frames_sent = frame
+            self.handle(msg)
+        datas.append(self._render(end - self._frames_sent))
+        self._frames_sent = end
+        return datas[0] if len(datas) == 1 else np.concatenate(datas)
+
+    @abc.abstractmethod
+    def _render(self, frames):
+        """Render the next `frames` frames, without handling messages."""
+
+    @abc.abstractmethod
+    def note_on(self, note, velocity):
+        pass
+
+    @abc.abstractmethod
+    def note_off(self, note):
+        pass
+
+    def bury_dead_notes(self):
+        """Forget about the notes that have finished playing."""
+
+
+class PolyphonicSynth(MidiSynth):
+    """Synth playing each note with its own Synth, created by create_note."""
+
+    @abc.abstractmethod
+    def create_note(self, note_number, velocity):
+        pass
+
+    def __init__(self, max_polyphony=10, gain=0.1, queue_size=1024):
+        super().__init__(max_polyphony, gain, queue_size)
+        self.note_synths = collections.OrderedDict()
+        self.note_synths_dying = []
+
+    def all_note_synths(self):
+        yield from iter(self.note_synths.values())
+        yield from iter(self.note_synths_dying)
 
     def note_on(self, note, velocity):
         # Don't let the same note play twice at the same time.
@@ -187,71 +418,484 @@ class PolyphonicSynth(Synth, metaclass=abc.ABCMeta):
             note_to_kill = next(iter(self.note_synths))
             self.note_off(note_to_kill)
 
-        note_synth = self.create_note(note, velocity)
-
-        with self._lock:
-            self.note_synths[note] = note_synth
+        self.note_synths[note] = self.create_note(note, velocity)
 
     def note_off(self, note):
-        with self._lock:
-            try:
-                prev_note = self.note_synths.pop(note)
-                prev_note.note_off()
-                self.note_synths_dying.append(prev_note)
-            except KeyError:
-                pass
-
-    def get_data(self, frames):
+        try:
+            prev_note = self.note_synths.pop(note)
+            prev_note.note_off()
+            self.note_synths_dying.append(prev_note)
+        except KeyError:
+            pass
+
+    def _render(self, frames):
         datas = [note_synth.get_data(frames) for note_synth in self.all_note_synths()]
-        self._t += frames/SAMPLERATE
+        if not datas:
+            return self._silence(frames)
         return np.sum(datas, axis=0) * self.gain
 
+    def _silence(self, frames):
+        return np.zeros(frames)
+
     def bury_dead_notes(self):
-        with self._lock:
-            self.note_synths_dying = list(filter(
-                    lambda note_synth: note_synth.is_alive,
-                    self.note_synths_dying))
+        self.note_synths_dying = list(filter(
+                lambda note_synth: note_synth.is_alive,
+                self.note_synths_dying))
+
+
+class VoicePolySynth(MidiSynth):
+    """Synth rendering all its voices at once, with array operations.
+
+    Instead of one Synth per note, the state of all the voices is kept in
+    arrays with one element per voice, and all the voices are rendered
+    as a (voices, frames) array. Up to `max_polyphony` notes can be held,
+    and the arrays grow if more voices are in their release phase.
+
+    Subclasses implement _render, freeing the voices whose notes have
+    finished, and list their own per-voice arrays in _VOICE_ARRAYS.
+    """
+    _VOICE_ARRAYS = ('_notes', '_held', '_frequencies', '_volumes', '_phases',
+                     '_env_t', '_env_levels', '_release_levels', '_ages')
 
-class SimplePolySynth(PolyphonicSynth):
-    def __init__(self, waveform, envelope, **kwargs):
+    def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self._waveform, self._envelope = waveform, envelope
+        n = 2 * self.max_polyphony
+        self._notes = np.full(n, -1) # -1 for free voices
+        self._held = np.zeros(n, dtype=bool)
+        self._frequencies = np.zeros(n)
+        self._volumes = np.zeros(n)
+        self._phases = np.zeros(n) # normalized, in [0, 1)
+        self._env_t = np.zeros(n) # time since note_on or note_off
+        self._env_levels = np.zeros(n) # last value of the envelope
+        self._release_levels = np.zeros(n)
+        self._ages = np.zeros(n, dtype=int) # order of the note_on
+        self._notes_played = 0
 
-    def create_note(self, note_number, velocity):
-        return OneNoteSynth(freq_of_note(note_number), velocity/128,
-                                  self._waveform, self._envelope)
+    def note_on(self, note, velocity):
+        # Don't let the same note play twice at the same time.
+        self._release(self._held & (self._notes == note))
+
+        # Don't let more than `max_polyphony` notes
+        # play at the same time.
+        held, = np.nonzero(self._held)
+        if len(held) >= self.max_polyphony:
+            self._release(held[np.argmin(self._ages[held])])
+
+        free, = np.nonzero(self._notes < 0)
+        if len(free) == 0:
+            free = [len(self._notes)]
+            self._add_voices()
+        self._start_voice(free[0], note, velocity)
+
+    def note_off(self, note):
+        self._release(self._held & (self._notes == note))
+
+    def _add_voices(self):
+        """Double the number of voices."""
+        for name in self._VOICE_ARRAYS:
+            array = getattr(self, name)
+            setattr(self, name, np.concatenate((array, np.zeros_like(array))))
+        self._notes[len(self._notes)//2:] = -1
+
+    def _start_voice(self, voice, note, velocity):
+        self._notes[voice] = note
+        self._held[voice] = True
+        self._frequencies[voice] = freq_of_note(note)
+        self._volumes[voice] = velocity/128
+        self._phases[voice] = 0.0
+        self._env_t[voice] = 0.0
+        self._env_levels[voice] = 0.0
+        self._ages[voice] = self._notes_played
+        self._notes_played += 1
+
+    def _release(self, voices):
+        """Begin the 'release' phase of some voices (indices or mask)."""
+        self._held[voices] = False
+        self._release_levels[voices] = self._env_levels[voices]
+        self._env_t[voices] = 0.0
+
+
+class WaveformPolySynth(VoicePolySynth):
+    """VoicePolySynth whose voices all have the same envelope.
+
+    Subclasses implement _render_voices, which renders the waveforms of the
+    voices, and the voices are summed with their envelope and volume.
+    """
+
+    def __init__(self, envelope, **kwargs):
+        super().__init__(**kwargs)
+        self._envelope = Envelope(*envelope)
+
+    @abc.abstractmethod
+    def _render_voices(self, voices, frames):
+        """Render the waveforms of some voices, without envelope nor volume.
+
+        voices : array of indices of the voices
+        returns : array of shape (len(voices), frames)
+        """
+
+    def _render(self, frames):
+        voices, = np.nonzero(self._notes >= 0)
+        data = self._apply_envelopes(voices,
+                                     self._render_voices(voices, frames))
+        return data * self.gain
+
+    def _apply_envelopes(self, voices, waves):
+        """Sum the waveforms of some voices, with their envelope and volume.
+
+        Voices staying in the same segment of their envelope during the
+        block are summed before applying their envelope, so that only the
+        voices changing segment need their envelope computed at every frame.
+        Voices whose release has finished are freed.
+        """
+        frames = waves.shape[1]
+        t = self._env_t[voices]
+        held = self._held[voices]
+        release_levels = self._release_levels[voices]
+        volumes = self._volumes[voices]
+        constant, slope, expo, rate, crossing, finished = envelope_segments(
+                self._envelope, t, held, release_levels, frames)
+
+        n = np.arange(frames)
+        data = (volumes * constant) @ waves
+        if slope.any():
+            data += n * ((volumes * slope) @ waves)
+        for segment_rate in np.unique(rate[expo != 0]):
+            segment = (rate == segment_rate) * expo
+            data += segment_rate**n * ((volumes * segment) @ waves)
+        levels = constant + slope * (frames-1) + expo * rate**(frames-1)
+
+        if crossing.any():
+            gains = envelope_levels(self._envelope,
+                                    t[crossing, np.newaxis] + n/SAMPLERATE,
+                                    held[crossing, np.newaxis],
+                                    release_levels[crossing, np.newaxis])
+            data += volumes[crossing] @ (waves[crossing] * gains)
+            levels[crossing] = gains[:, -1] if frames else 0.0
+
+        self._notes[voices[finished]] = -1
+        self._env_levels[voices] = levels
+        self._env_t[voices] += frames/SAMPLERATE
+        return data
+
+
+class SimplePolySynth(WaveformPolySynth):
+    def __init__(self, waveform, envelope, wavetable=False, **kwargs):
+        """
+        waveform : periodic function of period 1, or Wavetable
+        envelope : Envelope of the notes
+        wavetable : whether to render the waveform from band-limited tables
+        """
+        super().__init__(envelope, **kwargs)
+        self._waveform = get_wavetable(waveform) if wavetable else waveform
+
+    def _render_voices(self, voices, frames):
+        phases = np.multiply.outer(self._frequencies[voices],
+                                   np.arange(1, frames+1)/SAMPLERATE)
+        phases += self._phases[voices, np.newaxis]
+        phases -= np.floor(phases)
+        if frames:
+            self._phases[voices] = phases[:, -1]
+        if isinstance(self._waveform, Wavetable):
+            return self._waveform(phases, self._frequencies[voices])
+        return self._waveform(phases)
+
+
+Operator = collections.namedtuple('Operator',
+                                  ['ratio', 'envelope', 'level', 'velocity'],
+                                  defaults=[DEFAULT_ENVELOPE, 1.0, True])
+Operator.__doc__ = """Operator of an FMSynth: a sine oscillator with an envelope.
+
+ratio : frequency of the operator, relative to the frequency of the note
+envelope : Envelope of its amplitude
+level : amplitude of its output
+velocity : whether its amplitude is also proportional to the velocity
+"""
+
+
+class FMSynth(VoicePolySynth):
+    """Synth with several operators per voice, as the DX synthesizers.
+
+    Each operator is a sine oscillator whose phase is modulated by the
+    outputs of other operators, as given by a modulation matrix, and the
+    outputs of the carriers are summed. The operators of all the voices are
+    rendered at once, with arrays of shape (operators, voices, frames).
 
+    The operators are computed from the last to the first, so an operator
+    is modulated directly by the operators after it. It is modulated by
+    itself or by the operators before it (feedback) with a delay of one
+    sample: the operators of such loops are rendered one sample at a time,
+    with arrays of all the voices only, which costs much more.
+    """
+    _VOICE_ARRAYS = VoicePolySynth._VOICE_ARRAYS + ('_outputs',)
 
-class FMSynth(PolyphonicSynth):
-    """Synth with one level of Frequency Modulation."""
     def __init__(self, envelope=DEFAULT_ENVELOPE,
                  envelope_fm=DEFAULT_ENVELOPE,
                  fm_strength=1.0,
                  velocity_influences_fm=True,
+                 operators=None, modulation=None, carriers=None,
                  **kwargs):
+        """
+        envelope, envelope_fm, velocity_influences_fm : envelopes of the
+            carrier and of the modulator of the default patch, and whether
+            the velocity changes the amplitude of its modulator. Ignored if
+            operators are given.
+        fm_strength : modulation index, by which the modulation matrix is
+            multiplied. It can be changed while playing by control change 7.
+        operators : list of Operator. By default, one carrier modulated by
+            one operator at the same frequency.
+        modulation : matrix of shape (operators, operators), where
+            modulation[i][j] is the modulation index, in radians, of the
+            phase of operator i by the output of operator j
+        carriers : indices of the operators heard, by default those which
+            do not modulate other operators
+        """
+        if operators is None:
+            operators = [Operator(1.0, envelope),
+                         Operator(1.0, envelope_fm,
+                                  velocity=velocity_influences_fm)]
+            modulation = [[0.0, 1.0], [0.0, 0.0]]
+        self._operators = [Operator(*op) for op in operators]
+        n_ops = len(self._operators)
+        self._modulation = np.zeros((n_ops, n_ops)) if modulation is None \
+                               else np.array(modulation, dtype=float)
+        if carriers is None:
+            modulates = self._modulation * (1 - np.eye(n_ops)) != 0
+            carriers, = np.nonzero(~modulates.any(axis=0))
+        self._carriers = list(carriers)
         super().__init__(**kwargs)
-        self._envelope = envelope
-        self._envelope_fm = envelope_fm
         self._fm_strength = fm_strength
-        self._velocity_influences_fm = velocity_influences_fm
 
-    def receive(self, msg):
-        super().receive(msg)
+        self._ratios = np.array([op.ratio for op in self._operators])
+        self._levels = np.array([op.level for op in self._operators])
+        self._velocity = np.array([op.velocity for op in self._operators])
+        # Direct modulators (after) and feedback modulators (before or same)
+        self._modulators = [[j for j in np.nonzero(row)[0] if j > i]
+                            for i, row in enumerate(self._modulation)]
+        self._feedbacks = [[j for j in np.nonzero(row)[0] if j <= i]
+                           for i, row in enumerate(self._modulation)]
+        # Operators rendered one sample at a time, from the last to the first
+        loops = [(i, j) for i, row in enumerate(self._feedbacks) for j in row]
+        self._feedback_ops = list(range(max(i for i, _ in loops),
+                                        min(j for _, j in loops) - 1, -1)) \
+                                 if loops else []
+
+        # One column per operator
+        n = len(self._notes)
+        self._phases = np.zeros((n, n_ops))
+        self._env_levels = np.zeros((n, n_ops))
+        self._release_levels = np.zeros((n, n_ops))
+        self._outputs = np.zeros((n, n_ops)) # last sample, for the feedback
+
+    def handle(self, msg):
+        super().handle(msg)
         if msg.type == 'control_change' and msg.control == 7:
             self.set_fm_strength(msg.value/128.0 * 15.0)
 
     def set_fm_strength(self, fm_strength):
+        """Change the modulation index of the notes playing and to come."""
         self._fm_strength = fm_strength
-        for synth in self.all_note_synths():
-            synth.set_fm_strength(fm_strength)
 
-    def create_note(self, note_number, velocity):
-        freq = freq_of_note(note_number)
-        child_volume = velocity/128 if self._velocity_influences_fm else 1.0
-        fm_synth = OneNoteSynth(freq, child_volume,
-                                SINE_WAVE, self._envelope_fm)
-        return OneNoteSynth(freq, velocity/128, SINE_WAVE, self._envelope,
-                 fm=fm_synth, fm_strength=self._fm_strength)
+    def _start_voice(self, voice, note, velocity):
+        super()._start_voice(voice, note, velocity)
+        self._outputs[voice] = 0.0
+
+    def _render(self, frames):
+        voices, = np.nonzero(self._notes >= 0)
+        t = self._env_t[voices]
+        held = self._held[voices]
+        n_ops = len(self._operators)
+
+        # Amplitude of each operator
+        gains = np.empty((n_ops, len(voices), frames))
+        finished = np.ones(len(voices), dtype=bool)
+        for k, op in enumerate(self._operators):
+            gains[k], op_finished = envelope_gains(
+                    op.envelope, t, held, self._release_levels[voices, k],
+                    frames)
+            if k in self._carriers:
+                finished &= op_finished
+        if frames:
+            self._env_levels[voices] = gains[:, :, -1].T
+        amplitudes = np.where(self._velocity[:, np.newaxis],
+                              self._volumes[voices], 1.0)
+        gains *= (amplitudes * self._levels[:, np.newaxis])[:, :, np.newaxis]
+
+        # Phases without modulation, in radians
+        increments = np.multiply.outer(self._ratios, self._frequencies[voices])
+        phases = np.multiply.outer(increments, np.arange(1, frames+1)
+                                   / SAMPLERATE)
+        phases += self._phases[voices].T[:, :, np.newaxis]
+        if frames:
+            self._phases[voices] = (phases[:, :, -1] % 1.0).T
+        phases *= 2*np.pi
+
+        outputs = np.empty_like(phases)
+        indices = self._fm_strength * self._modulation
+        for k in reversed(range(n_ops)):
+            if k in self._feedback_ops:
+                if k == self._feedback_ops[0]:
+                    self._render_feedback(voices, phases, gains, indices,
+                                          outputs)
+                continue
+            for j in self._modulators[k]:
+                phases[k] += indices[k, j] * outputs[j]
+            np.sin(phases[k], out=outputs[k])
+            outputs[k] *= gains[k]
+        if frames:
+            self._outputs[voices] = outputs[:, :, -1].T
+
+        self._notes[voices[finished]] = -1
+        self._env_t[voices] += frames/SAMPLERATE
+        return outputs[self._carriers].sum(axis=(0, 1)) * self.gain
+
+    def _render_feedback(self, voices, phases, gains, indices, outputs):
+        """Render the operators of the feedback loops, one sample at a time.
+
+        Takes the arrays of _render, of shape (operators, voices, frames),
+        where the outputs of the operators after the loops are computed.
+        """
+        ops = self._feedback_ops
+        inputs = [] # (position in ops, index) of the inputs in the loops
+        for k in ops:
+            for j in self._modulators[k]:
+                if j not in ops:
+                    phases[k] += indices[k, j] * outputs[j]
+            inputs.append([(ops.index(j), indices[k, j])
+                           for j in self._modulators[k] + self._feedbacks[k]
+                           if j in ops])
+        # Contiguous (frames, voices) arrays, rendered in place
+        rows = [phases[k].T.copy() for k in ops]
+        op_gains = [gains[k].T.copy() for k in ops]
+        y = list(self._outputs[voices].T[ops]) # last sample of each operator
+        for n in range(phases.shape[2]):
+            for m, m_inputs in enumerate(inputs):
+                # y holds the current sample of the operators after ops[m],
+                # and the previous sample of the others
+                x = rows[m][n]
+                for i, index in m_inputs:
+                    x += index * y[i]
+                np.sin(x, out=x)
+                x *= op_gains[m][n]
+                y[m] = x
+        for k, row in zip(ops, rows):
+            outputs[k] = row.T
+
+
+
+class RenderAhead:
+    """Render audio in a worker thread, ahead of the audio callback.
+
+    The worker thread renders blocks into a SampleRing, keeping it up to
+    `blocks_ahead` blocks ahead of the audio callback, which only copies
+    them. This adds blocks_ahead*blocksize frames of latency, but a block
+    rendered late, because of a garbage collection or a note costly to
+    create, is absorbed by the blocks already in the ring.
+
+    The callback still needs the GIL, which the worker can keep for up to
+    sys.getswitchinterval() seconds: lower it for blocks shorter than that.
+
+    Usage:
+        ahead = RenderAhead(synth.get_data, blocksize=256, blocks_ahead=4)
+        def callback(indata, outdata, frames, time, status):
+            ahead.read(outdata[:, 0])
+        with ahead, sd.Stream(callback=callback, ...):
+            ...
+    """
+
+    def __init__(self, render, blocksize=256, blocks_ahead=4, channels=None):
+        """
+        render : function returning the next `frames` frames of audio,
+            such as Synth.get_data
+        blocksize : number of frames rendered at once
+        blocks_ahead : number of blocks rendered in advance, which sets
+            both the latency and the margin against late blocks
+        channels : number of channels returned by render, or None if it
+            returns 1-D arrays
+        """
+        self._render = render
+        self.blocksize = blocksize
+        self.channels = channels
+        self._ring = SampleRing(blocksize * blocks_ahead, channels)
+        self._frames_read = 0
+        self.underruns = 0 # calls to read which did not get all their frames
+        self.missing_frames = 0 # frames replaced by silence
+        self.lowest_fill = self._ring.capacity # lowest fill seen by read
+        self._worker = None
+        self._stopping = threading.Event()
+
+    @property
+    def latency(self):
+        """Latency added by the ring when it is full, in seconds."""
+        return self._ring.capacity / SAMPLERATE
+
+    @property
+    def fill(self):
+        """Number of frames rendered and not read yet."""
+        return len(self._ring)
+
+    def get_time(self):
+        """Time of the next frame read, in the units of MidiSynth.get_time."""
+        return self._frames_read / SAMPLERATE
+
+    def read(self, out):
+        """Copy the next len(out) frames to out, without waiting.
+
+        Called by the audio callback. The frames that are not rendered yet
+        are replaced by silence, and counted as an underrun.
+        """
+        fill = len(self._ring)
+        if fill < self.lowest_fill:
+            self.lowest_fill = fill
+        frames = self._ring.read(out)
+        if frames < len(out):
+            out[frames:] = 0.0
+            self.underruns += 1
+            self.missing_frames += len(out) - frames
+        self._frames_read += frames
+        return out
+
+    def get_data(self, frames):
+        """Next `frames` frames, in a new array."""
+        return self.read(np.empty(frames if self.channels is None
+                                  else (frames, self.channels)))
+
+    def format_stats(self):
+        """Fill level and underruns, on one line."""
+        return ("fill {} of {} frames, lowest {}, {} underruns, {} frames "
+                "missing".format(self.fill, self._ring.capacity,
+                                 self.lowest_fill, self.underruns,
+                                 self.missing_frames))
+
+    def start(self):
+        """Fill the ring, then start the worker thread."""
+        self._fill()
+        self._stopping.clear()
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        """Stop the worker thread. The frames in the ring are kept."""
+        if self._worker is not None:
+            self._stopping.set()
+            self._worker.join()
+            self._worker = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _fill(self):
+        while self._ring.space() >= self.blocksize:
+            self._ring.write(self._render(self.blocksize))
+
+    def _work(self):
+        # Polling, so that the callback never has to wake the worker up
+        while not self._stopping.wait(self.blocksize / SAMPLERATE / 2):
+            self._fill()
 
 
 
@@ -269,19 +913,77 @@ SIMPLE_FM_SYNTH = FMSynth(ORGAN_ENVELOPE,
                           fm_strength=5.0,
                           velocity_influences_fm=False)
 
+# Two stacks of two operators, the first modulator with some feedback
+EPIANO_ENVELOPE = Envelope(1e-3, 2.0, 0.1, 0.3, 'exponential')
+TINE_ENVELOPE = Envelope(1e-3, 0.3, 0.0, 0.3, 'exponential')
+EPIANO_SYNTH = FMSynth(operators=[Operator(1.0, EPIANO_ENVELOPE, 0.5),
+                                  Operator(1.0, TINE_ENVELOPE),
+                                  Operator(1.0, EPIANO_ENVELOPE, 0.5),
+                                  Operator(14.0, TINE_ENVELOPE, 0.5)],
+                       modulation=[[0, 1.5, 0, 0],
+                                   [0, 0.3, 0, 0],
+                                   [0, 0, 0, 1.0],
+                                   [0, 0, 0, 0]])
+
 if __name__ == '__main__':
+    # Blocks of a single envelope within one segment are computed as
+    # segments, without evaluating the envelope at every frame
+    fallbacks = 0
+    closed_form_levels = envelope_levels
+    def counting_levels(*args):
+        global fallbacks
+        fallbacks += 1
+        return closed_form_levels(*args)
+    envelope_levels = counting_levels
+    gain = EnvelopeGain(ORGAN_ENVELOPE)
+    gain.get_gain(int(0.6 * SAMPLERATE)) # attack and decay
+    fallbacks = 0
+    sustain = gain.get_gain(256)
+    gain.note_off()
+    release = gain.get_gain(256)
+    assert fallbacks == 0, fallbacks
+    envelope_levels = closed_form_levels
+    assert np.allclose(sustain, ORGAN_ENVELOPE.s)
+    assert np.allclose(release, envelope_levels(
+            ORGAN_ENVELOPE, np.arange(256)/SAMPLERATE, False,
+            ORGAN_ENVELOPE.s))
+
+    import argparse
+    import contextlib
     import sounddevice as sd
     import mido
     import time
+    from profiling import CallbackProfiler
 
+    parser = argparse.ArgumentParser(
+            description="Play the notes of the default MIDI input.")
+    parser.add_argument('--ahead', type=int, default=0, metavar='BLOCKS',
+                        help="Render this number of blocks of 256 frames "
+                             "ahead of the audio callback, in another "
+                             "thread (default 0, render in the callback)")
+    args = parser.parse_args()
 
     synth = SIMPLE_FM_SYNTH
+    get_data = CallbackProfiler(synth.get_data)
+    get_data.start_reporting(interval=10.0)
+    ahead = RenderAhead(get_data, 256, args.ahead) if args.ahead else None
 
     def callback(indata, outdata, frames, time, status):
-        outdata[:, 0] = synth.get_data(frames)
+        get_data.count_status(status)
+        if ahead is None:
+            outdata[:, 0] = get_data(frames)
+        else:
+            ahead.read(outdata[:, 0])
 
-    with sd.Stream(samplerate=SAMPLERATE, channels=1, callback=callback):
+    with ahead or contextlib.nullcontext(), \
+            sd.Stream(samplerate=SAMPLERATE, channels=1, callback=callback):
         with mido.open_input() as inport:
             inport.callback = synth.receive
-            while not inport.closed:
-                time.sleep(0.1)
+            try:
+                while not inport.closed:
+                    time.sleep(0.1)
+            finally:
+                get_data.stop_reporting()
+                print("Total:", get_data.format_stats())
+                if ahead is not None:
+                    print(ahead.format_stats())
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Pitch detection with the YIN algorithm.
+
+The difference function is computed with an FFT over a sliding window of the
+last samples, so that each block costs O(N log N).
+
+Reference: A. de Cheveigné and H. Kawahara, "YIN, a fundamental frequency
+estimator for speech and music", JASA 111(4), 2002.
+"""
+import numpy as np
+from filters import bandpass_filter
+
+
+class YinFinder:
+    def __init__(self, fs=44100, filt=None,
+                 f_min=50, f_max=1000, threshold=0.15):
+        """
+        Parameters
+        ----------
+        fs : sampling frequency
+        filt : Filter to apply to data
+        f_min, f_max : range of the detected frequencies
+        threshold : threshold on the normalized difference function.
+            Higher values detect more pitches, but make more octave errors.
+        """
+        self._fs = fs
+        if filt is None:
+            filt = bandpass_filter(f_low=f_min/2, f_high=2*f_max, order=2, fs=fs)
+        self._filter = filt
+        self._threshold = threshold
+        self._tau_min = max(int(fs/f_max), 2)
+        self._tau_max = int(np.ceil(fs/f_min))
+        # Integration window, and samples needed to compute all the lags
+        self._window = self._tau_max
+        self._buffer = np.zeros(self._window + self._tau_max)
+        self._nfft = 1 << (len(self._buffer) - 1).bit_length()
+        self._lags = np.arange(self._tau_max + 1)
+
+        self._period = np.nan # in samples
+        self.confidence = 0.0
+
+    def __call__(self, indata):
+        """Returns the estimated frequency of the signal."""
+        self.analyze(indata)
+        return self.get_estimated_frequency()
+
+    def analyze(self, indata):
+        filtered = self._filter(indata)
+        n = min(len(filtered), len(self._buffer))
+        self._buffer[:-n] = self._buffer[n:]
+        self._buffer[-n:] = filtered[-n:]
+        self._period, self.confidence = self._find_period(
+                self._cmnd(self._buffer))
+
+    def _cmnd(self, x):
+        """Cumulative mean normalized difference function of x, for all lags."""
+        W, tau_max = self._window, self._tau_max
+        spectrum = np.fft.rfft(x, self._nfft)
+        spectrum_ref = np.fft.rfft(x[:W], self._nfft)
+        corr = np.fft.irfft(spectrum * spectrum_ref.conj(), self._nfft)[:tau_max+1]
+        energy = np.concatenate(([0.0], np.cumsum(x**2)))
+        energy_lag = energy[W:W+tau_max+1] - energy[:tau_max+1]
+        diff = energy_lag[0] + energy_lag - 2*corr
+        cumdiff = np.cumsum(diff[1:])
+        cmnd = np.ones(tau_max + 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            cmnd[1:] = diff[1:] * self._lags[1:] / cumdiff
+        cmnd[~np.isfinite(cmnd)] = 1.0
+        return cmnd
+
+    def _find_period(self, cmnd):
+        """Find the period in samples, and a confidence value in [0, 1]."""
+        candidates = cmnd[self._tau_min:self._tau_max]
+        below, = np.nonzero(candidates < self._threshold)
+        if len(below) == 0:
+            return np.nan, 0.0
+        # Go down to the local minimum after the first dip
+        tau = self._tau_min + below[0]
+        while tau + 1 < self._tau_max and cmnd[tau+1] < cmnd[tau]:
+            tau += 1
+        # Parabolic interpolation
+        y0, y1, y2 = cmnd[tau-1:tau+2]
+        curvature = y0 - 2*y1 + y2
+        shift = (y0 - y2) / (2*curvature) if curvature > 0 else 0.0
+        return tau + shift, max(0.0, 1.0 - y1)
+
+    def get_estimated_period(self):
+        """Estimated period in samples."""
+        return self._period
+
+    def get_estimated_frequency(self):
+        """Estimated frequency in Hz."""
+        return self._fs / self._period
+
+
+
+
+### ------------------- Test that it works properly ---------------------------
+
+if __name__ == '__main__':
+    import numpy.random
+    import scipy.signal as ssi
+    import matplotlib.pyplot as plt
+
+    # Send a chirp with some noise, and try to recover its frequency
+    f0 = 50
+    f1 = 1000
+    t = np.arange(0, 10, 1/44100)
+    ft = f0 * (f1/f0)**(t/max(t))
+    chirp = ssi.chirp(t, f0, max(t), f1, method='log')
+    chirp += numpy.random.randn(len(chirp)) * 0.1
+
+    N = 256 # slice size
+    yf = YinFinder()
+    f_estimates = [yf(chirp[N*k:N*(k+1)]) for k in range(len(chirp)//N)]
+    f_correct = [ft[N*k] for k in range(len(chirp)//N)]
+
+    plt.loglog(f_correct, f_estimates)
+    plt.loglog(f_correct, f_correct)